@@ -0,0 +1,258 @@
+import hashlib
+import os
+import numpy as np
+
+# Which index backs the vector leg: 'exact' (brute force) or 'ivf'
+VECTOR_INDEX = os.environ.get('VECTOR_INDEX', 'exact')
+# IVF tuning: number of clusters (0 = pick from catalog size) and how many
+# clusters each query scans. Higher nprobe = better recall, lower QPS.
+VECTOR_INDEX_LISTS = int(os.environ.get('VECTOR_INDEX_LISTS', '0'))
+VECTOR_INDEX_NPROBE = int(os.environ.get('VECTOR_INDEX_NPROBE', '8'))
+# Optional file to load a prebuilt index from / save a freshly built one to
+VECTOR_INDEX_PATH = os.environ.get('VECTOR_INDEX_PATH')
+
+
+def top_k(scores, k):
+    """Indices of the k largest scores, best first"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def top_k_rows(scores, k):
+    """Per-row top_k of a 2-D score array: (indices, scores), each row best first"""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.empty((len(scores), 0), dtype=np.int64)
+        return empty, empty.astype(scores.dtype)
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+# Queries scored per matrix-matrix product in search_many, bounding the
+# (block, rows) score array
+_QUERY_BLOCK = 64
+
+
+def _search_masked(matrix, mask, query, k, rows=None):
+    """Exact top k among the rows selected by `mask` (whose ids are `rows`)"""
+    if rows is None:
+        rows = np.flatnonzero(mask)
+    if len(rows) * 2 > len(matrix):
+        # Mostly unfiltered: scanning everything beats gathering the rows
+        scores = matrix @ query
+        scores[~mask] = -np.inf
+        ids = top_k(scores, min(k, len(rows)))
+        return ids, scores[ids]
+    scores = matrix[rows] @ query
+    best = top_k(scores, k)
+    return rows[best], scores[best]
+
+
+class ExactIndex:
+    """Brute-force cosine scan over the whole (L2-normalized) matrix"""
+
+    kind = 'exact'
+
+    def build(self, matrix):
+        self.matrix = matrix
+        return self
+
+    def rebuild(self, matrix):
+        """Index for an updated matrix (same kind and tuning)"""
+        return ExactIndex().build(matrix)
+
+    def search(self, query, k, mask=None):
+        """
+        Return (row ids, scores) of the k best rows for a normalized query,
+        among the rows selected by the boolean `mask` if one is given
+        """
+        if mask is not None:
+            return _search_masked(self.matrix, mask, query, k)
+        scores = self.matrix @ query
+        ids = top_k(scores, k)
+        return ids, scores[ids]
+
+    def search_many(self, queries, k, mask=None):
+        """
+        search() for a (n, dims) array of normalized queries, scoring blocks of
+        queries with one matrix-matrix product; returns [(row ids, scores)]
+        """
+        matrix, rows, excluded = self.matrix, None, None
+        if mask is not None:
+            rows = np.flatnonzero(mask)
+            k = min(k, len(rows))
+            if len(rows) * 2 > len(self.matrix):
+                rows, excluded = None, ~mask
+            else:
+                matrix = self.matrix[rows]
+        results = []
+        for start in range(0, len(queries), _QUERY_BLOCK):
+            scores = (matrix @ queries[start:start + _QUERY_BLOCK].T).T
+            if excluded is not None:
+                scores[:, excluded] = -np.inf
+            ids, best = top_k_rows(scores, k)
+            if rows is not None:
+                ids = rows[ids]
+            results.extend(zip(ids, best))
+        return results
+
+    def save(self, path, fingerprint):
+        pass
+
+    def load(self, path, matrix, fingerprint):
+        return self.build(matrix)
+
+
+class IVFIndex:
+    """
+    Inverted-file index: rows are clustered with spherical k-means and a
+    query only scans the `nprobe` clusters whose centroids are closest.
+    """
+
+    kind = 'ivf'
+
+    def __init__(self, n_lists=VECTOR_INDEX_LISTS, nprobe=VECTOR_INDEX_NPROBE, iterations=10, seed=0):
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.seed = seed
+
+    def build(self, matrix):
+        self.matrix = matrix
+        n = len(matrix)
+        n_lists = self.n_lists or int(4 * np.sqrt(n))
+        n_lists = max(1, min(n_lists, n))
+
+        rng = np.random.default_rng(self.seed)
+        centroids = matrix[rng.choice(n, n_lists, replace=False)].copy()
+        for _ in range(self.iterations):
+            assign = self._assign(centroids)
+            order = np.argsort(assign, kind='stable')
+            counts = np.bincount(assign, minlength=n_lists)
+            starts = np.cumsum(counts) - counts
+            empty = counts == 0
+            sums = np.zeros_like(centroids)
+            sums[~empty] = np.add.reduceat(matrix[order], starts[~empty])
+            # Re-seed empty clusters with random rows
+            sums[empty] = matrix[rng.choice(n, int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        self.centroids = centroids
+        self._set_lists(self._assign(centroids))
+        return self
+
+    def rebuild(self, matrix):
+        """
+        Index for an updated matrix: keeps the trained centroids and only
+        reassigns rows to lists, which is far cheaper than re-clustering.
+        """
+        index = IVFIndex(self.n_lists, self.nprobe, self.iterations, self.seed)
+        index.matrix = matrix
+        index.centroids = self.centroids
+        index._set_lists(index._assign(self.centroids))
+        return index
+
+    def _assign(self, centroids, chunk=65536):
+        assign = np.empty(len(self.matrix), dtype=np.int64)
+        for start in range(0, len(self.matrix), chunk):
+            block = self.matrix[start:start + chunk] @ centroids.T
+            assign[start:start + chunk] = np.argmax(block, axis=1)
+        return assign
+
+    def _set_lists(self, assign):
+        # Row ids grouped by cluster; list i is list_rows[offsets[i]:offsets[i + 1]]
+        self.list_rows = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=len(self.centroids))
+        self.list_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def search(self, query, k, nprobe=None, mask=None):
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        if mask is not None:
+            rows = np.flatnonzero(mask)
+            # A filter selecting fewer rows than the probed lists hold is
+            # cheaper to scan exactly (and can't come up short)
+            if len(rows) <= len(self.matrix) * nprobe / len(self.centroids):
+                return _search_masked(self.matrix, mask, query, k, rows)
+        probes = top_k(self.centroids @ query, nprobe)
+        candidates = np.concatenate([
+            self.list_rows[self.list_offsets[p]:self.list_offsets[p + 1]] for p in probes
+        ])
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        scores = self.matrix[candidates] @ query
+        best = top_k(scores, k)
+        return candidates[best], scores[best]
+
+    def search_many(self, queries, k, nprobe=None, mask=None):
+        """search() per query: each one probes its own lists"""
+        return [self.search(query, k, nprobe, mask) for query in queries]
+
+    def save(self, path, fingerprint):
+        # Written to a temp file and renamed, so a worker starting at the
+        # same time never loads a partly written index
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                list_rows=self.list_rows,
+                list_offsets=self.list_offsets,
+                fingerprint=np.array(fingerprint)
+            )
+        os.replace(tmp, path)
+
+    def load(self, path, matrix, fingerprint):
+        """Load a saved index for `matrix`; returns None if it was built for other rows"""
+        data = np.load(path)
+        if str(data['fingerprint']) != fingerprint:
+            return None
+        self.matrix = matrix
+        self.centroids = data['centroids']
+        self.list_rows = data['list_rows']
+        self.list_offsets = data['list_offsets']
+        return self
+
+
+INDEX_TYPES = {
+    'exact': ExactIndex,
+    'ivf': IVFIndex,
+}
+
+
+def fingerprint(skus, matrix):
+    """Identifies the row layout an index was built for"""
+    digest = hashlib.sha1('\n'.join(skus).encode('utf-8'))
+    digest.update(str(matrix.shape).encode('ascii'))
+    return digest.hexdigest()
+
+
+def build_index(matrix, skus, kind=VECTOR_INDEX, path=VECTOR_INDEX_PATH):
+    """
+    Build the configured index over `matrix` (rows aligned with `skus`),
+    reusing a saved index from `path` when it was built for the same rows
+    and saving a freshly built one there otherwise.
+    """
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown VECTOR_INDEX '{kind}', expected one of {sorted(INDEX_TYPES)}")
+    if len(matrix) == 0:
+        return ExactIndex().build(matrix)
+
+    key = fingerprint(skus, matrix)
+    if path and os.path.exists(path):
+        index = INDEX_TYPES[kind]().load(path, matrix, key)
+        if index is not None:
+            print(f"Loaded {kind} vector index from {path}")
+            return index
+        print(f"Vector index at {path} doesn't match the embeddings, rebuilding")
+
+    index = INDEX_TYPES[kind]().build(matrix)
+    if path:
+        index.save(path, key)
+    return index
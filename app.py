@@ -1,17 +1,53 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional, Any
-from datetime import datetime, timedelta
+from datetime import datetime
 import mysql.connector
-import json
-import uuid
-import numpy as np
-from sentence_transformers import SentenceTransformer
 import os
+from contextlib import asynccontextmanager
+
+import db
+import lexical_index
+import metrics
+import pricing_config
+import product_cache
+import quote_service
+import search_filters
+import suggest
+from model_registry import encode_query, load_model, query_cache_stats, unload_models
+from quote_service import QuoteError
+from schema import require_schema
+from search_filters import make_filters, sql_conditions
+from search_service import (
+    SEARCH_LEG_DB_TIMEOUT, SEARCH_LEG_SQL_HINT, cached_search, get_product_details, hybrid_search_many,
+    run_search_legs, search_cache_stats
+)
+from vector_store import get_vector_store
+
+# --- Lifespan: load shared resources once ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Migrations run once per deploy (python schema.py), not in every worker;
+    # quotes, the product cache and the vector store need their columns
+    require_schema()
+    load_model()
+    product_cache.start_watcher()
+    lexical_index.start()
+    search_filters.start()
+    suggest.start()
+    # Preload embeddings so the first search's vector leg isn't cut off by
+    # the leg timeout while the matrix loads
+    try:
+        get_vector_store().ensure_loaded(db.get_connection)
+    except Exception as e:
+        print(f"Vector store preload failed, will load on first search: {e}")
+    get_vector_store().start_refresher(db.get_connection)
+    yield
+    unload_models()
 
 # --- CORS Middleware ---
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 origins = [
     "http://localhost:3000", 
     "https://database-five-mu.vercel.app",
@@ -22,24 +58,32 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Server-Timing"],
 )
 
+# --- Stage Timing ---
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    """Collect per-stage timings for the request and report them in Server-Timing"""
+    timings = metrics.begin_request()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.end_request(timings, request.method, route.path if route else "unmatched")
+    if metrics.METRICS_ENABLED:
+        response.headers["Server-Timing"] = timings.server_timing()
+    return response
+
 # --- Database Connection ---
 
-def get_db_connection():
-    """Connect to MySQL database using environment variables"""
+def get_db_connection(timeout=None):
+    """Check out a pooled MySQL connection (configured from environment variables)"""
     try:
-        connection = mysql.connector.connect(
-            host=os.environ['DB_HOST'], 
-            port=int(os.environ['DB_PORT']),  
-            user=os.environ['DB_USER'], 
-            password=os.environ['DB_PASSWORD'],  
-            database=os.environ['DB_NAME'], 
-            connect_timeout=10
-        )
-        return connection
+        return db.get_connection(timeout)
     except KeyError as e:
         raise HTTPException(status_code=500, detail=f"Missing environment variable: {str(e)}")
+    except mysql.connector.errors.PoolError as err:
+        print(f"Database pool exhausted: {err}")
+        raise HTTPException(status_code=503, detail=str(err))
     except mysql.connector.Error as err:
         print(f"Database connection error: {err}")
         raise HTTPException(status_code=500, detail=f"Database connection failed: {str(err)}")
@@ -52,6 +96,15 @@ class Product(BaseModel):
     category: Optional[str]
     unit_price: float
 
+class SearchBatchIn(BaseModel):
+    queries: List[str]
+    limit: int = 20
+    alpha: float = 0.6
+    brand: Optional[str] = None
+    category: Optional[str] = None
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+
 class QuoteLineIn(BaseModel):
     sku: str
     qty: int
@@ -80,74 +133,89 @@ class QuoteOut(BaseModel):
     notes: List[str]
     lines: List[QuoteLineOut]
 
-# --- Helper: Load Embeddings from Separate Table (BLOB) ---
-def load_embeddings():
-    cnx = get_db_connection()
+# --- Hybrid Search ---
+@metrics.timed('keyword')
+def keyword_search(q, limit, filters=None):
+    """
+    BM25 plus SKU/brand substring matches from the in-memory lexical index;
+    falls back to FULLTEXT and LIKE in MySQL while the index isn't built
+    """
+    results = lexical_index.search(q, limit, filters)
+    if results is not None:
+        return results
+
+    conditions, params = sql_conditions(filters)
+    where = ''.join(f"\n              AND {condition}" for condition in conditions)
+    cnx = get_db_connection(SEARCH_LEG_DB_TIMEOUT)
     cursor = cnx.cursor(dictionary=True)
-    cursor.execute("SELECT sku, vec FROM embeddings WHERE vec IS NOT NULL")
-    embeddings = {}
-    for row in cursor.fetchall():
-        # 'vec' is a BLOB of 384 float32 values (1536 bytes)
-        emb = np.frombuffer(row['vec'], dtype=np.float32)
-        embeddings[row['sku']] = emb
-    cursor.close()
-    cnx.close()
-    return embeddings
+    try:
+        cursor.execute(f"""
+            SELECT {SEARCH_LEG_SQL_HINT} sku, name, brand, unit_price,
+                   MATCH(searchable_text) AGAINST (%s IN BOOLEAN MODE) AS bm25_score
+            FROM products
+            WHERE (MATCH(searchable_text) AGAINST (%s IN BOOLEAN MODE)
+               OR name LIKE %s
+               OR brand LIKE %s
+               OR sku LIKE %s){where}
+            ORDER BY bm25_score DESC
+            LIMIT %s
+        """, (
+            q + '*', q + '*', f"%{q}%", f"%{q}%", f"%{q}%", *params, limit
+        ))
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+        cnx.close()
+
+@metrics.timed('vector')
+def vector_search(q, limit, filters=None):
+    """Vector similarity search against the resident embedding matrix"""
+    store = get_vector_store()
+    store.ensure_loaded(get_db_connection)
+    query_emb = encode_query(q)
+    return store.search(query_emb, limit, filters)
 
-# --- Hybrid Search ---
 @app.get("/search")
 def hybrid_search(
     q: str = Query(..., min_length=1),
     limit: int = 20,
-    alpha: float = 0.6
+    alpha: float = 0.6,
+    brand: Optional[str] = None,
+    category: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
 ):
-    cnx = get_db_connection()
-    cursor = cnx.cursor(dictionary=True)
+    filters = make_filters(brand, category, min_price, max_price)
+    return cached_search('api', q, limit, alpha, lambda: run_hybrid_search(q, limit, alpha, filters), filters)
+
+def run_hybrid_search(q, limit, alpha, filters=None):
+    # 1-2. Keyword and vector legs run concurrently, each applying the
+    # filters itself; a failed or slow leg degrades to the other one
+    bm25_results, vector_scores = run_search_legs(
+        lambda: keyword_search(q, limit, filters),
+        lambda: vector_search(q, limit, filters),
+    )
 
-    # 1. Full-text search (BM25) and LIKE on name, brand, sku
-    cursor.execute("""
-        SELECT sku, name, brand, unit_price,
-               MATCH(searchable_text) AGAINST (%s IN BOOLEAN MODE) AS bm25_score
-        FROM products
-        WHERE MATCH(searchable_text) AGAINST (%s IN BOOLEAN MODE)
-           OR name LIKE %s
-           OR brand LIKE %s
-           OR sku LIKE %s
-        ORDER BY bm25_score DESC
-        LIMIT %s
-    """, (
-        q + '*', q + '*', f"%{q}%", f"%{q}%", f"%{q}%", limit
-    ))
-    bm25_results = cursor.fetchall()
-
-    # 2. Vector similarity search using embeddings table
-    embeddings = load_embeddings()
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    query_emb = model.encode(q)
-    vector_scores = []
-    for sku, emb in embeddings.items():
-        score = float(np.dot(query_emb, emb) / (np.linalg.norm(query_emb) * np.linalg.norm(emb)))
-        vector_scores.append((sku, score))
-    vector_scores = sorted(vector_scores, key=lambda x: x[1], reverse=True)[:limit]
-
-    # 3. Merge results
-    bm25_dict = {row['sku']: row for row in bm25_results}
-    vector_dict = dict(vector_scores)
-    all_skus = set(bm25_dict.keys()) | set(vector_dict.keys())
+    # 3. Merge scores and keep the top N
+    with metrics.stage('fuse'):
+        bm25_dict = {row['sku']: row for row in bm25_results}
+        vector_dict = dict(vector_scores)
+        all_skus = set(bm25_dict.keys()) | set(vector_dict.keys())
+        scored = []
+        for sku in all_skus:
+            bm25_score = bm25_dict.get(sku, {}).get('bm25_score', 0)
+            vector_score = vector_dict.get(sku, 0)
+            scored.append((alpha * vector_score + (1 - alpha) * bm25_score, sku))
+        scored.sort(key=lambda x: x[0], reverse=True)
+        scored = scored[:limit]
+
+    # 4. Hydrate only the final hits; vector-only hits come from one batched lookup
+    vector_only = [sku for _, sku in scored if sku not in bm25_dict]
+    with metrics.stage('hydrate'):
+        products = get_product_details(vector_only)
     results = []
-    for sku in all_skus:
-        bm25 = bm25_dict.get(sku, {})
-        bm25_score = bm25.get('bm25_score', 0)
-        vector_score = vector_dict.get(sku, 0)
-        hybrid_score = alpha * vector_score + (1 - alpha) * bm25_score
-
-        # Fetch product info if not in bm25 results
-        if bm25:
-            prod = bm25
-        else:
-            cursor.execute("SELECT sku, name, brand, unit_price FROM products WHERE sku = %s", (sku,))
-            prod = cursor.fetchone()
-
+    for hybrid_score, sku in scored:
+        prod = bm25_dict.get(sku) or products.get(sku)
         if prod:
             results.append({
                 "sku": prod['sku'],
@@ -157,162 +225,160 @@ def hybrid_search(
                 "hybrid_score": hybrid_score
             })
 
-    cursor.close()
-    cnx.close()
-    # Sort by hybrid score and return top N
-    return {"results": sorted(results, key=lambda x: x['hybrid_score'], reverse=True)[:limit]}
+    return {"results": results}
+
+# --- Batch Search ---
+SEARCH_BATCH_MAX = int(os.environ.get('SEARCH_BATCH_MAX', '256'))
+
+@app.post("/search/batch")
+def search_batch(batch: SearchBatchIn):
+    """
+    Hybrid search for many queries in one request: queries are encoded and
+    scored against the embedding matrix together; returns one result list
+    per query, in order. A query's `degraded` is true when one of its search
+    legs failed or timed out, so its list is missing that leg's hits.
+    """
+    if not batch.queries:
+        raise HTTPException(status_code=400, detail="Queries must be a non-empty list.")
+    if len(batch.queries) > SEARCH_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {SEARCH_BATCH_MAX} queries per batch.")
+    if any(not q.strip() for q in batch.queries):
+        raise HTTPException(status_code=400, detail="Queries must not be empty.")
+    results, degraded = hybrid_search_many(batch.queries, batch.alpha, batch.limit, batch.brand,
+                                 batch.category, batch.min_price, batch.max_price)
+    return {
+        "degraded": any(degraded),
+        "results": [
+            {"query": q, "degraded": d, "results": r}
+            for q, r, d in zip(batch.queries, results, degraded)
+        ],
+    }
+
+# --- Typeahead Suggestions ---
+@app.get("/suggest")
+def suggest_prefix(prefix: str = Query(..., min_length=1), limit: int = 10):
+    """Product name, brand and SKU completions from memory (no DB or model access)"""
+    return {"suggestions": suggest.suggest(prefix, limit)}
 
 # --- Product Details by SKU ---
 @app.get("/products/{sku}", response_model=Product)
 def get_product(sku: str):
-    cnx = get_db_connection()
-    cursor = cnx.cursor(dictionary=True)
-    cursor.execute("SELECT sku, name, brand, category, unit_price FROM products WHERE sku = %s", (sku,))
-    prod = cursor.fetchone()
-    cursor.close()
-    cnx.close()
+    prod = product_cache.get_product(sku)
     if not prod:
         raise HTTPException(status_code=404, detail="Product not found")
-    return prod
+    return prod._asdict()
 
 # --- Quote Creation ---
+QUOTE_BATCH_MAX = int(os.environ.get('QUOTE_BATCH_MAX', '500'))
+
+def quote_lines(quote: QuoteCreateIn):
+    return [{"sku": line.sku, "qty": line.qty, "attributes": line.attributes} for line in quote.lines]
+
 @app.post("/quotes")
 def create_quote(quote: QuoteCreateIn):
-    cnx = get_db_connection()
-    cursor = cnx.cursor(dictionary=True)
     try:
-        cnx.start_transaction()
-        # Validate customerRef
-        if not quote.customerRef or not isinstance(quote.customerRef, str):
-            raise HTTPException(status_code=400, detail="Customer reference must be a non-empty string.")
-        if not quote.lines or not isinstance(quote.lines, list):
-            raise HTTPException(status_code=400, detail="Lines must be a non-empty list.")
-
-        quote_id = 'CRQ-' + uuid.uuid4().hex[:8].upper()
-        valid_until = datetime.now() + timedelta(hours=24)
-
-        # Get pricing config
-        cursor.execute("SELECT transfer_discount, installments_markup FROM config_pricing WHERE id = 1")
-        config = cursor.fetchone()
-        if not config:
-            raise HTTPException(status_code=500, detail="Pricing config not found in the database.")
-
-        transfer_discount = float(config['transfer_discount'])
-        installments_markup = float(config['installments_markup'])
-
-        # Insert the quote first with placeholder totals
-        cursor.execute("""
-            INSERT INTO quotes (quote_id, customer_ref, valid_until, list_total, transfer_total, installments_total, notes)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (
-            quote_id,
-            quote.customerRef,
-            valid_until.strftime('%Y-%m-%d %H:%M:%S'),
-            0, 0, 0,
-            json.dumps(["Stock will be confirmed before fulfillment."])
-        ))
-
-        list_total = 0.0
-        for idx, line in enumerate(quote.lines):
-            sku = line.sku
-            qty = line.qty
-            attrs = line.attributes or {}
-
-            if not sku or not isinstance(qty, int) or qty <= 0:
-                raise HTTPException(status_code=400, detail=f"Invalid SKU or quantity at line {idx + 1}")
-
-            cursor.execute("SELECT unit_price, name FROM products WHERE sku = %s", (sku,))
-            product = cursor.fetchone()
-            if not product:
-                raise HTTPException(status_code=400, detail=f"Invalid SKU: {sku}")
-
-            unit_price = float(product['unit_price'])
-            name = product['name']
-            line_total = unit_price * qty
-            list_total += line_total
-
-            cursor.execute("""
-                INSERT INTO quote_lines (quote_id, line_number, sku, name, qty, unit_price, line_total, attrs)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                quote_id,
-                idx + 1,
-                sku,
-                name,
-                qty,
-                unit_price,
-                line_total,
-                json.dumps(attrs)
-            ))
-
-        transfer_total = list_total * (1 - transfer_discount)
-        installments_total = list_total * (1 + installments_markup)
-
-        cursor.execute("""
-            UPDATE quotes
-            SET list_total = %s, transfer_total = %s, installments_total = %s
-            WHERE quote_id = %s
-        """, (
-            list_total,
-            transfer_total,
-            installments_total,
-            quote_id
-        ))
-
-        cnx.commit()
-        return {"success": True, "quoteId": quote_id}
-    except HTTPException as e:
-        cnx.rollback()
-        raise e
+        quote_id = quote_service.create_quote(quote.customerRef, quote_lines(quote))
+    except QuoteError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except mysql.connector.errors.PoolError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        cnx.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        cnx.close()
+    return {"success": True, "quoteId": quote_id}
+
+@app.post("/quotes/batch")
+def create_quotes_batch(quotes: List[QuoteCreateIn]):
+    """Create many quotes in one request; returns per-quote success or error"""
+    if not quotes:
+        raise HTTPException(status_code=400, detail="Quotes must be a non-empty list.")
+    if len(quotes) > QUOTE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {QUOTE_BATCH_MAX} quotes per batch.")
+    try:
+        results = quote_service.create_quotes([(q.customerRef, quote_lines(q)) for q in quotes])
+    except mysql.connector.errors.PoolError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    succeeded = sum(1 for r in results if r["success"])
+    return {"succeeded": succeeded, "failed": len(results) - succeeded, "results": results}
 
 # --- Quote Retrieval ---
+def etag_matches(if_none_match: Optional[str], etag: str):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f"W/{etag}" in tags
+
 @app.get("/quotes/{quote_id}", response_model=QuoteOut)
-def get_quote(quote_id: str):
-    cnx = get_db_connection()
-    cursor = cnx.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM quotes WHERE quote_id = %s", (quote_id,))
-    quote = cursor.fetchone()
-    if not quote:
-        cursor.close()
-        cnx.close()
+def get_quote(quote_id: str, if_none_match: Optional[str] = Header(None)):
+    result = quote_service.get_quote_json(quote_id)
+    if result is None:
         raise HTTPException(status_code=404, detail="Quote not found")
 
-    cursor.execute("SELECT * FROM quote_lines WHERE quote_id = %s ORDER BY line_number", (quote_id,))
-    lines = cursor.fetchall()
-    cursor.close()
-    cnx.close()
-
-    # Parse notes and attrs
-    notes = json.loads(quote['notes']) if quote['notes'] else []
-    line_objs = []
-    for line in lines:
-        attrs = json.loads(line['attrs']) if line['attrs'] else {}
-        line_objs.append(QuoteLineOut(
-            line_number=line['line_number'],
-            sku=line['sku'],
-            name=line['name'],
-            qty=line['qty'],
-            unit_price=line['unit_price'],
-            line_total=line['line_total'],
-            attrs=attrs
-        ))
+    body, etag = result
+    # no-cache: browsers keep the body but revalidate it with If-None-Match
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# --- Vector Index ---
+@app.get("/admin/vector-index")
+def vector_index_status():
+    return get_vector_store().status()
+
+@app.post("/admin/vector-index/refresh")
+def refresh_vector_index():
+    """Pick up embeddings written since the last load and swap in the new index"""
+    store = get_vector_store()
+    try:
+        applied = store.refresh(db.get_connection)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return dict(store.status(), applied=applied)
 
-    return QuoteOut(
-        quote_id=quote['quote_id'],
-        customer_ref=quote['customer_ref'],
-        valid_until=quote['valid_until'],
-        list_total=quote['list_total'],
-        transfer_total=quote['transfer_total'],
-        installments_total=quote['installments_total'],
-        notes=notes,
-        lines=line_objs
-    )
+# --- Pricing Config ---
+@app.post("/admin/pricing/reload")
+def reload_pricing_config():
+    """Re-read config_pricing now instead of waiting for the refresh interval"""
+    try:
+        config = pricing_config.reload()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"version": config.version, "transfer_discount": config.transfer_discount,
+            "installments_markup": config.installments_markup}
+
+# --- Database Pool Stats ---
+@app.get("/admin/db-pool")
+def db_pool_stats():
+    return db.get_pool_stats()
+
+# --- Cache Stats ---
+@app.get("/admin/caches")
+def cache_stats():
+    return {
+        "search_results": search_cache_stats(),
+        "query_embeddings": query_cache_stats(),
+        "products": product_cache.stats(),
+        "lexical_index": lexical_index.stats(),
+        "suggest": suggest.stats(),
+        "quotes": quote_service.quote_cache_stats(),
+    }
+
+# --- Prometheus Metrics ---
+@app.get("/metrics")
+def prometheus_metrics():
+    pool = db.get_pool_stats()
+    body = metrics.render([
+        ("app_db_pool_size", "gauge", "Connection pool size.", pool["size"]),
+        ("app_db_pool_in_use", "gauge", "Connections currently checked out.", pool["in_use"]),
+        ("app_db_pool_checkouts_total", "counter", "Connections checked out.", pool["checkouts"]),
+        ("app_db_pool_timeouts_total", "counter", "Checkouts that timed out waiting.", pool["timeouts"]),
+        ("app_db_pool_recycled_total", "counter", "Connections reopened for age.", pool["recycled"]),
+        ("app_db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection.",
+         pool["wait_seconds_total"]),
+    ])
+    return Response(content=body, media_type="text/plain; version=0.0.4")
 
 # --- Root Endpoint ---
 @app.get("/")
@@ -321,8 +387,11 @@ def root():
         "message": "Casa Rom Sales API",
         "endpoints": [
             "/search?q=term",
+            "/search/batch (POST)",
+            "/suggest?prefix=term",
             "/products/{sku}",
             "/quotes (POST)",
+            "/quotes/batch (POST)",
             "/quotes/{quote_id}"
         ]
     }
\ No newline at end of file
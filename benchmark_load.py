@@ -0,0 +1,412 @@
+"""
+Load / latency benchmark for the HTTP API.
+
+`seed` fills the database named by the DB_* env vars with a synthetic
+catalog (products, embeddings, config_pricing, quotes, quote_lines), so
+runs are reproducible on a throwaway MySQL. It refuses to touch a database
+whose DB_NAME doesn't match BENCH_DATABASE_PATTERN (default: contains
+'bench') unless given --allow-any-database. `run` drives a running API
+with a fixed-concurrency pool of clients and reports p50/p95/p99 latency
+and throughput per endpoint.
+
+    DB_NAME=casa_rom_bench python benchmark_load.py seed --products 20000 --quotes 2000 --reset
+    uvicorn app:app --workers 4
+    python benchmark_load.py run --concurrency 16 --requests 5000 --json
+    python benchmark_load.py run --record workload.jsonl      # save the generated requests
+    python benchmark_load.py run --replay workload.jsonl      # replay a request log
+
+A request log is JSONL, one request per line:
+
+    {"method": "GET", "path": "/search?q=porcelanato&limit=20"}
+    {"method": "POST", "path": "/quotes", "body": {"customerRef": "C-1", "lines": [...]}}
+
+Seeded embeddings are random clustered vectors, which exercises the vector
+leg at full cost but not its ranking quality; run
+`python generate_embeddings.py --force` afterwards for real ones.
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+BRANDS = ['Cerro Negro', 'San Lorenzo', 'Alberdi', 'Ilva', 'FV', 'Piazza', 'Roca', 'Ferrum', 'Lourdes', 'Cortines']
+CATEGORIES = ['porcelanato', 'cerámica', 'mosaico', 'revestimiento', 'grifería', 'sanitario', 'vanitory', 'pegamento']
+MATERIALS = ['símil madera', 'mármol', 'cemento', 'piedra', 'rústico', 'pulido', 'satinado', 'esmaltado']
+COLORS = ['blanco', 'gris', 'negro', 'beige', 'arena', 'grafito', 'nogal', 'roble', 'marfil', 'terracota']
+SIZES = ['30x30', '45x45', '60x60', '60x120', '20x120', '33x33', '25x40', '80x80']
+
+# Seeding only runs against databases whose name matches this
+BENCH_DATABASE_PATTERN = os.environ.get('BENCH_DATABASE_PATTERN', 'bench')
+
+# Default request mix for generated workloads: kind -> relative weight
+DEFAULT_MIX = 'search=6,product=2,quote_create=1,quote_get=1'
+
+# Endpoint label for each request path, so per-endpoint stats group by route
+ROUTES = [
+    ('GET', re.compile(r'^/search$'), 'GET /search'),
+    ('GET', re.compile(r'^/products/[^/]+$'), 'GET /products/{sku}'),
+    ('POST', re.compile(r'^/quotes$'), 'POST /quotes'),
+    ('POST', re.compile(r'^/quotes/batch$'), 'POST /quotes/batch'),
+    ('GET', re.compile(r'^/quotes/[^/]+$'), 'GET /quotes/{quote_id}'),
+]
+
+
+# --- Seeding ---
+
+def synthetic_product(rng, number):
+    category = CATEGORIES[rng.integers(len(CATEGORIES))]
+    material = MATERIALS[rng.integers(len(MATERIALS))]
+    color = COLORS[rng.integers(len(COLORS))]
+    size = SIZES[rng.integers(len(SIZES))]
+    brand = BRANDS[rng.integers(len(BRANDS))]
+    sku = f"{rng.integers(1000, 9999)}-{number:06d}"
+    name = f"{category.capitalize()} {material} {color} {size}"
+    searchable_text = f"{name} {brand} {category} {material} {color} {size} {sku}"
+    unit_price = round(float(rng.uniform(500, 90000)), 2)
+    return sku, name, brand, category, unit_price, searchable_text
+
+
+def check_bench_database(allow_any=False):
+    """Exit unless DB_NAME looks like a benchmark database (or allow_any)"""
+    name = os.environ.get('DB_NAME', '')
+    if allow_any or re.search(BENCH_DATABASE_PATTERN, name, re.IGNORECASE):
+        return
+    raise SystemExit(
+        f"Refusing to seed database '{name}': its name doesn't match BENCH_DATABASE_PATTERN "
+        f"'{BENCH_DATABASE_PATTERN}'. Point DB_NAME at a throwaway benchmark database, "
+        f"or pass --allow-any-database."
+    )
+
+
+def seed_database(products=20000, quotes=2000, dims=384, seed=0, batch=1000, reset=False):
+    """Create the base tables and fill them with a reproducible synthetic catalog"""
+    from benchmark_vectors import synthetic_matrix
+    from db import get_connection
+    from model_registry import MODEL_NAME
+    from product_cache import ProductRecord
+    import pricing_config
+    from quote_service import insert_quotes, price_quote
+    from schema import create_base_tables
+
+    create_base_tables()
+    rng = np.random.default_rng(seed)
+    rows = [synthetic_product(rng, i) for i in range(products)]
+    matrix = synthetic_matrix(products, dims, seed)
+
+    cnx = get_connection()
+    cursor = cnx.cursor()
+    try:
+        if reset:
+            for table in ('quote_lines', 'quotes', 'embeddings', 'products'):
+                cursor.execute(f"DELETE FROM {table}")
+            cnx.commit()
+
+        start = time.perf_counter()
+        for offset in range(0, products, batch):
+            cursor.executemany("""
+                INSERT INTO products (sku, name, brand, category, unit_price, searchable_text)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE name = VALUES(name), brand = VALUES(brand), category = VALUES(category),
+                    unit_price = VALUES(unit_price), searchable_text = VALUES(searchable_text)
+            """, rows[offset:offset + batch])
+            cursor.executemany("""
+                INSERT INTO embeddings (sku, vec, dims, model, content_hash)
+                VALUES (%s, %s, %s, %s, NULL)
+                ON DUPLICATE KEY UPDATE vec = VALUES(vec), dims = VALUES(dims), model = VALUES(model),
+                    content_hash = NULL
+            """, [(row[0], matrix[offset + i].tobytes(), dims, MODEL_NAME)
+                  for i, row in enumerate(rows[offset:offset + batch])])
+            cnx.commit()
+        print(f"Seeded {products} products and embeddings in {time.perf_counter() - start:.1f}s")
+
+        cursor.execute("""
+            INSERT INTO config_pricing (id, transfer_discount, installments_markup) VALUES (1, 0.10, 0.20)
+            ON DUPLICATE KEY UPDATE id = id
+        """)
+        cnx.commit()
+        config = pricing_config.reload()
+
+        records = {row[0]: ProductRecord(*row[:5]) for row in rows}
+        skus = [row[0] for row in rows]
+        start = time.perf_counter()
+        for offset in range(0, quotes, batch):
+            priced = []
+            for i in range(offset, min(offset + batch, quotes)):
+                lines = [(skus[j], int(rng.integers(1, 40)), {})
+                         for j in rng.choice(len(skus), size=int(rng.integers(1, 8)), replace=False)]
+                priced.append(price_quote(f"BENCH-{i:06d}", lines, records, config))
+            insert_quotes(cursor, priced)
+            cnx.commit()
+        print(f"Seeded {quotes} quotes in {time.perf_counter() - start:.1f}s")
+    finally:
+        cursor.close()
+        cnx.close()
+
+
+# --- Workload ---
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        mix[kind.strip()] = float(weight or 1)
+    unknown = set(mix) - set(WORKLOADS)
+    if unknown:
+        raise ValueError(f"Unknown request kinds {sorted(unknown)}, expected {sorted(WORKLOADS)}")
+    return mix
+
+
+def load_samples(limit=5000):
+    """SKUs, product names and quote ids to build requests from (deterministic order)"""
+    from db import get_connection
+
+    cnx = get_connection()
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT sku, name FROM products ORDER BY sku LIMIT %s", (limit,))
+        products = cursor.fetchall()
+        cursor.execute("SELECT quote_id FROM quotes ORDER BY quote_id LIMIT %s", (limit,))
+        quote_ids = [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+        cnx.close()
+    if not products:
+        raise RuntimeError("No products found; run `benchmark_load.py seed` first")
+    return products, quote_ids
+
+
+def search_request(rng, products, quote_ids):
+    sku, name = products[rng.integers(len(products))]
+    words = name.split()
+    roll = rng.random()
+    if roll < 0.1:
+        q = sku
+    elif roll < 0.4:
+        q = words[0]
+    else:
+        q = ' '.join(words[:int(rng.integers(2, len(words) + 1))])
+    return {'method': 'GET', 'path': '/search?' + urllib.parse.urlencode({'q': q, 'limit': 20})}
+
+
+def product_request(rng, products, quote_ids):
+    sku = products[rng.integers(len(products))][0]
+    return {'method': 'GET', 'path': '/products/' + urllib.parse.quote(sku, safe='')}
+
+
+def quote_create_request(rng, products, quote_ids):
+    picks = rng.choice(len(products), size=min(len(products), int(rng.integers(1, 8))), replace=False)
+    lines = [{'sku': products[i][0], 'qty': int(rng.integers(1, 40))} for i in picks]
+    return {'method': 'POST', 'path': '/quotes', 'body': {'customerRef': 'BENCH-LOAD', 'lines': lines}}
+
+
+def quote_get_request(rng, products, quote_ids):
+    if not quote_ids:
+        return quote_create_request(rng, products, quote_ids)
+    return {'method': 'GET', 'path': '/quotes/' + quote_ids[rng.integers(len(quote_ids))]}
+
+
+WORKLOADS = {
+    'search': search_request,
+    'product': product_request,
+    'quote_create': quote_create_request,
+    'quote_get': quote_get_request,
+}
+
+
+def generate_workload(count, mix, seed=0):
+    """A reproducible list of requests drawn from `mix` ({kind: weight})"""
+    products, quote_ids = load_samples()
+    rng = np.random.default_rng(seed)
+    kinds = list(mix)
+    weights = np.array([mix[kind] for kind in kinds], dtype=float)
+    choices = rng.choice(len(kinds), size=count, p=weights / weights.sum())
+    return [WORKLOADS[kinds[i]](rng, products, quote_ids) for i in choices]
+
+
+def read_log(path):
+    """Requests from a JSONL log; lines without a path are skipped"""
+    requests = []
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not item.get('path'):
+                print(f"Skipping line {number} of {path}: no request path")
+                continue
+            requests.append({'method': item.get('method', 'GET').upper(), 'path': item['path'],
+                             'body': item.get('body')})
+    return requests
+
+
+def write_log(path, requests):
+    with open(path, 'w', encoding='utf-8') as f:
+        for item in requests:
+            f.write(json.dumps(item) + '\n')
+
+
+# --- Load generation ---
+
+def endpoint_label(method, path):
+    route = urllib.parse.urlsplit(path).path
+    for route_method, pattern, label in ROUTES:
+        if method == route_method and pattern.match(route):
+            return label
+    return f"{method} {route}"
+
+
+def send(base_url, item, timeout):
+    """Issue one request; returns (endpoint label, HTTP status or 0, seconds)"""
+    body = item.get('body')
+    request = urllib.request.Request(
+        base_url.rstrip('/') + item['path'],
+        data=json.dumps(body).encode('utf-8') if body is not None else None,
+        method=item.get('method', 'GET'),
+        headers={'Content-Type': 'application/json'} if body is not None else {},
+    )
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = 0
+    return endpoint_label(item.get('method', 'GET'), item['path']), status, time.perf_counter() - start
+
+
+def run_load(base_url, requests, concurrency, timeout=30.0):
+    """
+    Replay `requests` with `concurrency` clients, each sending its next
+    request as soon as the previous one completes (closed loop).
+    Returns ([(label, status, seconds)], wall seconds).
+    """
+    results = []
+    lock = threading.Lock()
+    pending = iter(requests)
+
+    def client():
+        while True:
+            with lock:
+                item = next(pending, None)
+            if item is None:
+                return
+            result = send(base_url, item, timeout)
+            with lock:
+                results.append(result)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(client)
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    """Per-endpoint (and overall) latency percentiles in ms and throughput in req/s"""
+    groups = defaultdict(list)
+    for label, status, seconds in results:
+        groups[label].append((status, seconds))
+        groups['all'].append((status, seconds))
+
+    summary = {}
+    for label, samples in sorted(groups.items()):
+        latencies = np.array([seconds for _, seconds in samples]) * 1000.0
+        statuses = defaultdict(int)
+        for status, _ in samples:
+            statuses[str(status)] += 1
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        summary[label] = {
+            'count': len(samples),
+            'errors': sum(1 for status, _ in samples if status == 0 or status >= 500),
+            'statuses': dict(statuses),
+            'throughput_rps': len(samples) / elapsed if elapsed else 0.0,
+            'mean_ms': float(latencies.mean()),
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+            'max_ms': float(latencies.max()),
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed = commands.add_parser('seed', help='fill the DB_* database with a synthetic catalog')
+    seed.add_argument('--products', type=int, default=20000)
+    seed.add_argument('--quotes', type=int, default=2000)
+    seed.add_argument('--dims', type=int, default=384)
+    seed.add_argument('--batch', type=int, default=1000)
+    seed.add_argument('--seed', type=int, default=0)
+    seed.add_argument('--reset', action='store_true', help='delete existing products, embeddings and quotes first')
+    seed.add_argument('--allow-any-database', action='store_true',
+                      help='seed even if DB_NAME does not match BENCH_DATABASE_PATTERN')
+
+    run = commands.add_parser('run', help='drive a running API and report latency')
+    run.add_argument('--url', default='http://127.0.0.1:8000')
+    run.add_argument('--concurrency', type=int, default=8)
+    run.add_argument('--requests', type=int, default=2000, help='generated requests (ignored with --replay)')
+    run.add_argument('--warmup', type=int, default=100,
+                     help='unmeasured requests sent first (taken off the front of a --replay log)')
+    run.add_argument('--mix', default=DEFAULT_MIX, help='request kinds and weights, e.g. search=1,product=1')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--timeout', type=float, default=30.0)
+    run.add_argument('--replay', help='JSONL request log to replay instead of generating requests')
+    run.add_argument('--record', help='write the requests sent to this JSONL file')
+    run.add_argument('--json', action='store_true', help='emit the report as one JSON object')
+    args = parser.parse_args()
+
+    if args.command == 'seed':
+        check_bench_database(args.allow_any_database)
+        seed_database(args.products, args.quotes, args.dims, args.seed, args.batch, args.reset)
+        return
+
+    # Warmup requests are never measured again, so the measured run doesn't
+    # start with guaranteed cache hits (or re-create the warmup's quotes)
+    if args.replay:
+        requests = read_log(args.replay)
+        warmup, requests = requests[:args.warmup], requests[args.warmup:]
+    else:
+        mix = parse_mix(args.mix)
+        requests = generate_workload(args.requests, mix, args.seed)
+        # A seed sequence no plain integer --seed produces
+        warmup = generate_workload(args.warmup, mix, [args.seed, 1]) if args.warmup else []
+    if args.record:
+        write_log(args.record, requests)
+
+    if warmup:
+        run_load(args.url, warmup, args.concurrency, args.timeout)
+    results, elapsed = run_load(args.url, requests, args.concurrency, args.timeout)
+    summary = summarize(results, elapsed)
+
+    if args.json:
+        print(json.dumps({
+            'url': args.url,
+            'concurrency': args.concurrency,
+            'requests': len(requests),
+            'source': args.replay or f"generated (mix={args.mix}, seed={args.seed})",
+            'elapsed_seconds': elapsed,
+            'endpoints': summary,
+        }))
+        return
+
+    print(f"{len(requests)} requests, concurrency {args.concurrency}, {elapsed:.1f}s")
+    for label, row in summary.items():
+        print(f"{label:<24} n={row['count']:<6} err={row['errors']:<4} {row['throughput_rps']:>8.1f} req/s  "
+              f"p50={row['p50_ms']:>7.1f}ms  p95={row['p95_ms']:>7.1f}ms  p99={row['p99_ms']:>7.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Recall / latency benchmark for the vector leg's ANN indexes.
+
+Compares each index configuration against the exact brute-force scan and
+reports recall@k, QPS and build time, so the IVF breadth (lists / nprobe)
+can be chosen per deployment. With --quantization it instead reports
+accuracy vs memory for each VECTOR_STORAGE option.
+
+    python benchmark_vectors.py                       # embeddings table (DB_* env vars)
+    python benchmark_vectors.py --synthetic 200000    # clustered random vectors
+    python benchmark_vectors.py --nprobe 1 4 8 16 32 --json
+    python benchmark_vectors.py --quantization --rescore-factor 4
+"""
+import argparse
+import json
+import time
+import numpy as np
+
+from ann_index import ExactIndex, IVFIndex, top_k
+from quantization import VECTOR_RESCORE_FACTOR, quantize
+from vector_store import build_matrix
+
+
+def load_db_matrix():
+    from db import get_connection
+
+    cnx = get_connection()
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT sku, vec FROM embeddings WHERE vec IS NOT NULL")
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        cnx.close()
+    return build_matrix(rows)[1]
+
+
+def synthetic_matrix(n, dims, seed=0):
+    """Clustered unit vectors, closer to real catalog embeddings than pure noise"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, n // 50), dims)).astype(np.float32)
+    matrix = centers[rng.integers(0, len(centers), n)]
+    matrix += 0.5 * rng.standard_normal((n, dims)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix
+
+
+def make_queries(matrix, count, noise, seed=1):
+    """Perturbed catalog rows stand in for encoded user queries"""
+    rng = np.random.default_rng(seed)
+    queries = matrix[rng.integers(0, len(matrix), count)].copy()
+    queries += noise * rng.standard_normal(queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries
+
+
+def run_queries(index, queries, k, **kwargs):
+    start = time.perf_counter()
+    results = [index.search(q, k, **kwargs)[0] for q in queries]
+    elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def recall_at_k(results, truth, k):
+    hits = sum(len(set(r[:k]) & set(t[:k])) for r, t in zip(results, truth))
+    return hits / float(k * len(truth))
+
+
+def quantization_report(matrix, queries, k, rescore_factor, report):
+    """
+    For each storage option: memory, recall@k and score error of the coarse
+    scan alone, and recall@k after re-scoring the top k * rescore_factor
+    candidates at full precision (what VectorStore does).
+    """
+    exact_scores = [matrix @ q for q in queries]
+    truth = [top_k(scores, k) for scores in exact_scores]
+
+    for storage in ('float32', 'float16', 'int8'):
+        compact = quantize(matrix, storage)
+        coarse_hits = rescored_hits = 0
+        errors = []
+        start = time.perf_counter()
+        for q, exact, expected in zip(queries, exact_scores, truth):
+            coarse = compact @ q
+            candidates = top_k(coarse, k * rescore_factor)
+            rescored = candidates[top_k(matrix[candidates] @ q, k)]
+            coarse_hits += len(set(candidates[:k]) & set(expected))
+            rescored_hits += len(set(rescored) & set(expected))
+            errors.append(np.abs(coarse[expected] - exact[expected]).mean())
+        elapsed = time.perf_counter() - start
+        report({
+            'storage': storage,
+            'memory_mib': compact.nbytes / 2**20,
+            'coarse_recall': coarse_hits / float(k * len(queries)),
+            'rescored_recall': rescored_hits / float(k * len(queries)),
+            'mean_abs_score_error': float(np.mean(errors)),
+            'qps': len(queries) / elapsed,
+            'n': len(matrix),
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--synthetic', type=int, default=0, help='use N synthetic vectors instead of the DB')
+    parser.add_argument('--dims', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--noise', type=float, default=0.3, help='query perturbation (std dev)')
+    parser.add_argument('-k', type=int, default=20)
+    parser.add_argument('--lists', type=int, nargs='*', default=[0], help='IVF list counts (0 = auto)')
+    parser.add_argument('--nprobe', type=int, nargs='*', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--quantization', action='store_true', help='report accuracy vs memory per storage type')
+    parser.add_argument('--rescore-factor', type=int, default=VECTOR_RESCORE_FACTOR)
+    parser.add_argument('--json', action='store_true', help='emit one JSON object per configuration')
+    args = parser.parse_args()
+
+    matrix = synthetic_matrix(args.synthetic, args.dims) if args.synthetic else load_db_matrix()
+    queries = make_queries(matrix, args.queries, args.noise)
+    k = args.k
+
+    def report(row):
+        if args.json:
+            print(json.dumps(row))
+        else:
+            print(f"{row['index']:<6} lists={row['lists']:<6} nprobe={row['nprobe']:<4} "
+                  f"recall@{k}={row['recall']:.4f}  qps={row['qps']:>9.1f}  "
+                  f"build={row['build_seconds']:.2f}s")
+
+    if not args.json:
+        print(f"{len(matrix)} vectors x {matrix.shape[1]} dims, {len(queries)} queries, k={k}")
+
+    if args.quantization:
+        def report_storage(row):
+            if args.json:
+                print(json.dumps(row))
+            else:
+                print(f"{row['storage']:<8} {row['memory_mib']:>8.1f} MiB  "
+                      f"coarse recall@{k}={row['coarse_recall']:.4f}  "
+                      f"rescored recall@{k}={row['rescored_recall']:.4f}  "
+                      f"score err={row['mean_abs_score_error']:.5f}  qps={row['qps']:>8.1f}")
+        quantization_report(matrix, queries, k, args.rescore_factor, report_storage)
+        return
+
+    exact = ExactIndex().build(matrix)
+    truth, elapsed = run_queries(exact, queries, k)
+    report({'index': 'exact', 'lists': 0, 'nprobe': 0, 'recall': 1.0,
+            'qps': len(queries) / elapsed, 'build_seconds': 0.0, 'n': len(matrix)})
+
+    for lists in args.lists:
+        start = time.perf_counter()
+        ivf = IVFIndex(n_lists=lists).build(matrix)
+        build_seconds = time.perf_counter() - start
+        for nprobe in args.nprobe:
+            results, elapsed = run_queries(ivf, queries, k, nprobe=nprobe)
+            report({'index': 'ivf', 'lists': len(ivf.centroids), 'nprobe': nprobe,
+                    'recall': recall_at_k(results, truth, k), 'qps': len(queries) / elapsed,
+                    'build_seconds': build_seconds, 'n': len(matrix)})
+
+
+if __name__ == "__main__":
+    main()
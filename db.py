@@ -1,112 +1,179 @@
 import mysql.connector
-from mysql.connector import errorcode
-from datetime import datetime, timedelta
-import json
-import uuid
-
-def create_quote(customer_ref, lines):
-    cnx = mysql.connector.connect(
-        host='localhost',
-        user='root',               # Change as needed
-        password='mahin1tanim2@',  # Change as needed
-        database='casa_rom_sales'
-    )
-    cursor = cnx.cursor(dictionary=True)
-
+from mysql.connector import errorcode, pooling
+import os
+import threading
+import time
+
+import metrics
+
+# --- Connection Pool ---
+# Credentials come from DB_HOST / DB_PORT / DB_USER / DB_PASSWORD / DB_NAME.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))            # max 32 (mysql-connector limit)
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))     # seconds to wait for a free connection
+DB_POOL_RECYCLE = float(os.environ.get('DB_POOL_RECYCLE', '1800'))  # reconnect connections older than this
+
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_pool_stats = {
+    'checkouts': 0,
+    'in_use': 0,
+    'timeouts': 0,
+    'recycled': 0,
+    'wait_seconds_total': 0.0,
+    'wait_seconds_max': 0.0,
+}
+
+
+def _db_config():
+    return {
+        'host': os.environ['DB_HOST'],
+        'port': int(os.environ.get('DB_PORT', '3306')),
+        'user': os.environ['DB_USER'],
+        'password': os.environ['DB_PASSWORD'],
+        'database': os.environ['DB_NAME'],
+        'connect_timeout': 10,
+    }
+
+
+def get_pool():
+    """Create the process-wide connection pool on first use"""
+    global _pool, _pool_slots
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name='casa_rom',
+                    pool_size=DB_POOL_SIZE,
+                    pool_reset_session=True,
+                    **_db_config()
+                )
+    return _pool
+
+
+class PooledConnection:
+    """A checked-out pool connection; close() returns it to the pool"""
+
+    def __init__(self, cnx):
+        self._cnx = cnx
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._cnx, name)
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._cnx.cursor(*args, **kwargs))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._cnx.close()
+        finally:
+            _pool_slots.release()
+            with _stats_lock:
+                _pool_stats['in_use'] -= 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class InstrumentedCursor:
+    """Cursor wrapper that counts and times statements for metrics"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(*args, **kwargs)
+        finally:
+            metrics.record_query(time.perf_counter() - start)
+
+    def executemany(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(*args, **kwargs)
+        finally:
+            metrics.record_query(time.perf_counter() - start)
+
+
+def get_connection(timeout=None):
+    """
+    Check out a connection from the shared pool, waiting up to `timeout`
+    (default DB_POOL_TIMEOUT) seconds for one to become free. The pool pings each connection on checkout
+    and reconnects it if the server dropped it; connections older than
+    DB_POOL_RECYCLE seconds are reopened.
+    """
+    if timeout is None:
+        timeout = DB_POOL_TIMEOUT
+    pool = get_pool()
+    start = time.perf_counter()
+    if not _pool_slots.acquire(timeout=timeout):
+        with _stats_lock:
+            _pool_stats['timeouts'] += 1
+        raise mysql.connector.errors.PoolError(
+            f"Timed out after {timeout}s waiting for a database connection"
+        )
     try:
-        cnx.start_transaction()
-
-        quote_id = 'CRQ-' + uuid.uuid4().hex[:8].upper()
-        valid_until = datetime.now() + timedelta(hours=24)
-
-        # Get pricing config
-        cursor.execute("SELECT transfer_discount, installments_markup FROM config_pricing WHERE id = 1")
-        config = cursor.fetchone()
-        if not config:
-            raise Exception("Pricing config not found")
-
-        transfer_discount = float(config['transfer_discount'])
-        installments_markup = float(config['installments_markup'])
-
-        if not lines or not isinstance(lines, list):
-            raise Exception("Lines must be a non-empty list")
-
-        # Insert the quote first with placeholder totals
-        cursor.execute("""
-            INSERT INTO quotes (quote_id, customer_ref, valid_until, list_total, transfer_total, installments_total, notes)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (
-            quote_id,
-            customer_ref,
-            valid_until.strftime('%Y-%m-%d %H:%M:%S'),
-            0,  # placeholder
-            0,  # placeholder
-            0,  # placeholder
-            json.dumps(["Stock will be confirmed before fulfillment."])
-        ))
-
-        list_total = 0.0
-
-        # Now process and insert quote lines
-        for idx, line in enumerate(lines):
-            sku = line.get('sku')
-            qty = line.get('qty')
-            attrs = line.get('attributes', {})
-
-            if not sku or not isinstance(qty, int) or qty <= 0:
-                raise Exception(f"Invalid SKU or quantity at line {idx + 1}")
-
-            cursor.execute("SELECT unit_price, name FROM products WHERE sku = %s", (sku,))
-            product = cursor.fetchone()
-            if not product:
-                raise Exception(f"Invalid SKU: {sku}")
-
-            unit_price = float(product['unit_price'])
-            name = product['name']
-
-            line_total = unit_price * qty
-            list_total += line_total
-
-            cursor.execute("""
-                INSERT INTO quote_lines (quote_id, line_number, sku, name, qty, unit_price, line_total, attrs)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                quote_id,
-                idx + 1,
-                sku,
-                name,
-                qty,
-                unit_price,
-                line_total,
-                json.dumps(attrs)
-            ))
-
-        # Calculate totals
-        transfer_total = list_total * (1 - transfer_discount)
-        installments_total = list_total * (1 + installments_markup)
-
-        # Update the quote with the correct totals
-        cursor.execute("""
-            UPDATE quotes
-            SET list_total = %s, transfer_total = %s, installments_total = %s
-            WHERE quote_id = %s
-        """, (
-            list_total,
-            transfer_total,
-            installments_total,
-            quote_id
-        ))
-
-        cnx.commit()
-        return quote_id
-
-    except Exception as e:
-        cnx.rollback()
-        raise e
-
-    finally:
-        cursor.close()
-        cnx.close()
+        cnx = pool.get_connection()
+    except Exception:
+        _pool_slots.release()
+        raise
+    wait = time.perf_counter() - start
+    metrics.observe('db_pool_wait', wait)
+
+    raw = cnx._cnx
+    now = time.monotonic()
+    created_at = getattr(raw, '_pool_created_at', None)
+    recycled = False
+    if created_at is None:
+        raw._pool_created_at = now
+    elif now - created_at > DB_POOL_RECYCLE:
+        try:
+            raw.reconnect()
+        except Exception:
+            cnx.close()
+            _pool_slots.release()
+            raise
+        raw._pool_created_at = now
+        recycled = True
+
+    with _stats_lock:
+        _pool_stats['checkouts'] += 1
+        _pool_stats['in_use'] += 1
+        _pool_stats['wait_seconds_total'] += wait
+        _pool_stats['wait_seconds_max'] = max(_pool_stats['wait_seconds_max'], wait)
+        if recycled:
+            _pool_stats['recycled'] += 1
+    return PooledConnection(cnx)
+
+
+def get_pool_stats():
+    with _stats_lock:
+        stats = dict(_pool_stats)
+    stats['size'] = DB_POOL_SIZE
+    return stats
+
+
+# --- Quote Creation ---
+def create_quote(customer_ref, lines):
+    """Create a quote; see quote_service.create_quote"""
+    from quote_service import create_quote as _create_quote
+    return _create_quote(customer_ref, lines)
 
 # Example usage:
 if __name__ == "__main__":
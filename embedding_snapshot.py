@@ -0,0 +1,104 @@
+"""
+Versioned on-disk snapshot of the normalized embedding matrix.
+
+    {EMBEDDING_SNAPSHOT_DIR}/CURRENT          name of the live version directory
+    {EMBEDDING_SNAPSHOT_DIR}/v<N>/matrix.npy  (rows, dims) float32, L2-normalized
+    {EMBEDDING_SNAPSHOT_DIR}/v<N>/skus.json   SKU of each matrix row
+    {EMBEDDING_SNAPSHOT_DIR}/v<N>/header.json model, dims, rows and the embeddings
+                                              change marker the snapshot reflects
+
+Search processes np.load() the matrix with mmap_mode='r', so every uvicorn
+worker shares the same page-cache copy and starts without touching MySQL.
+"""
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+from model_registry import MODEL_NAME
+
+EMBEDDING_SNAPSHOT_DIR = os.environ.get('EMBEDDING_SNAPSHOT_DIR', 'embedding_snapshot')
+# Older versions kept around for workers that still have them mapped
+SNAPSHOT_KEEP = int(os.environ.get('EMBEDDING_SNAPSHOT_KEEP', '2'))
+
+FORMAT = 1
+
+
+def _marker_fields(marker):
+    return {'rows': int(marker[0]), 'updated_at': str(marker[1]) if marker[1] is not None else None}
+
+
+def write_snapshot(skus, matrix, marker, directory=EMBEDDING_SNAPSHOT_DIR):
+    """Write a new snapshot version and point CURRENT at it; returns its path"""
+    os.makedirs(directory, exist_ok=True)
+    version = time.time_ns()
+    final = os.path.join(directory, f"v{version}")
+    tmp = final + '.tmp'
+    os.makedirs(tmp)
+
+    np.save(os.path.join(tmp, 'matrix.npy'), np.ascontiguousarray(matrix, dtype=np.float32))
+    with open(os.path.join(tmp, 'skus.json'), 'w', encoding='utf-8') as f:
+        json.dump([str(sku) for sku in skus], f)
+    header = dict(
+        _marker_fields(marker),
+        format=FORMAT,
+        version=version,
+        model=MODEL_NAME,
+        dims=int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+        created_at=time.time(),
+    )
+    with open(os.path.join(tmp, 'header.json'), 'w', encoding='utf-8') as f:
+        json.dump(header, f)
+    os.rename(tmp, final)
+
+    current_tmp = os.path.join(directory, 'CURRENT.tmp')
+    with open(current_tmp, 'w', encoding='utf-8') as f:
+        f.write(f"v{version}")
+    os.replace(current_tmp, os.path.join(directory, 'CURRENT'))
+
+    _prune(directory)
+    print(f"Wrote embedding snapshot v{version} ({len(skus)} rows) to {directory}")
+    return final
+
+
+def _prune(directory):
+    versions = sorted(
+        (name for name in os.listdir(directory) if name.startswith('v') and not name.endswith('.tmp')),
+        key=lambda name: int(name[1:])
+    )
+    for name in versions[:-SNAPSHOT_KEEP]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def read_header(directory=EMBEDDING_SNAPSHOT_DIR):
+    """Header of the current snapshot, or None if there isn't one"""
+    try:
+        with open(os.path.join(directory, 'CURRENT'), encoding='utf-8') as f:
+            path = os.path.join(directory, f.read().strip())
+        with open(os.path.join(path, 'header.json'), encoding='utf-8') as f:
+            header = json.load(f)
+    except (OSError, ValueError):
+        return None
+    header['path'] = path
+    return header
+
+
+def is_fresh(header, marker):
+    """True if the snapshot matches the current model and embeddings marker"""
+    return (
+        header is not None
+        and header.get('format') == FORMAT
+        and header.get('model') == MODEL_NAME
+        and dict(_marker_fields(marker)) == {'rows': header.get('rows'), 'updated_at': header.get('updated_at')}
+    )
+
+
+def load_snapshot(header):
+    """Memory-map a snapshot's matrix; returns (skus, matrix)"""
+    matrix = np.load(os.path.join(header['path'], 'matrix.npy'), mmap_mode='r')
+    with open(os.path.join(header['path'], 'skus.json'), encoding='utf-8') as f:
+        skus = np.array(json.load(f), dtype=object)
+    if len(skus) != len(matrix):
+        raise ValueError(f"Snapshot {header['path']} has {len(skus)} SKUs for {len(matrix)} rows")
+    return skus, matrix
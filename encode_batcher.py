@@ -0,0 +1,101 @@
+"""
+Micro-batching for query encoding.
+
+Concurrent searches each need one short string encoded. Encoding them one
+at a time wastes most of a forward pass, so callers queue their text and a
+single worker thread encodes whatever arrived within ENCODE_BATCH_WINDOW_MS
+of the first queued query (or as soon as ENCODE_BATCH_MAX are waiting) in
+one batched call.
+"""
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+# How long the first queued query waits for others to join its batch
+# (0 disables batching; every query is encoded on its own)
+ENCODE_BATCH_WINDOW = float(os.environ.get('ENCODE_BATCH_WINDOW_MS', '2')) / 1000.0
+ENCODE_BATCH_MAX = int(os.environ.get('ENCODE_BATCH_MAX', '32'))
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+_batch_sizes = metrics.histogram(
+    'app_encode_batch_size', 'Queries encoded per batched model call.', BATCH_SIZE_BUCKETS
+)
+
+
+class EncodeBatcher:
+    """
+    Collects texts from any thread and encodes them in batches with
+    `encode_batch(texts) -> (len(texts), dims) array` on a worker thread.
+    """
+
+    def __init__(self, encode_batch, window=ENCODE_BATCH_WINDOW, max_batch=ENCODE_BATCH_MAX, name='encode'):
+        self._encode_batch = encode_batch
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = []        # (text, future, enqueued at)
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=f"{name}-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        """Queue a text; the returned future resolves to its vector"""
+        future = Future()
+        with self._cond:
+            self._queue.append((text, future, time.perf_counter()))
+            if len(self._queue) == 1 or len(self._queue) >= self.max_batch:
+                self._cond.notify()
+        return future
+
+    def encode(self, text):
+        """
+        Encode one text as part of the next batch; blocks until it's done.
+        Records the wait for the batch as encode_queue and its model call as
+        encode, so the two add up to the caller's time.
+        """
+        future = self.submit(text)
+        vec = future.result()
+        metrics.observe('encode_queue', future.queue_wait)
+        metrics.observe('encode', future.encode_time)
+        return vec
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            deadline = self._queue[0][2] + self.window
+            while len(self._queue) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._queue[:self.max_batch]
+            del self._queue[:self.max_batch]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started = time.perf_counter()
+            # The same query from several callers is encoded once
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            try:
+                with metrics.stage('encode_batch'):
+                    vectors = self._encode_batch(texts)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            encode_time = time.perf_counter() - started
+
+            _batch_sizes.observe(len(texts))
+            # Rows are copied out: callers cache them, and a row view would
+            # keep the whole batch array alive
+            by_text = {text: vec.copy() for text, vec in zip(texts, vectors)}
+            for text, future, enqueued in batch:
+                future.queue_wait = started - enqueued
+                future.encode_time = encode_time
+                future.set_result(by_text[text])
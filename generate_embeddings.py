@@ -1,73 +1,112 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import mysql.connector
-from sentence_transformers import SentenceTransformer
-import numpy as np
-
-# Load embedding model
-print("Loading embedding model...")
-model = SentenceTransformer('all-MiniLM-L6-v2')  # Fast and efficient model
-
-def get_db_connection():
-    return mysql.connector.connect(
-        host='localhost',
-        user='root',
-        password='mahin1tanim2@',  # <-- Change to your actual password
-        database='casa_rom_sales'
-    )
 
-def generate_embeddings():
+import embedding_snapshot
+from db import get_connection as get_db_connection
+from model_registry import MODEL_NAME, load_model
+from schema import ensure_schema
+from vector_store import build_matrix, read_marker
+
+# Products encoded per model.encode call (and written per batched upsert)
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', '64'))
+
+# Backfill: products streamed per chunk, encoding processes, and where the
+# last committed SKU is recorded so an interrupted run can resume
+BACKFILL_CHUNK_SIZE = int(os.environ.get('BACKFILL_CHUNK_SIZE', '1024'))
+BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', str(max(1, (os.cpu_count() or 2) - 1))))
+BACKFILL_CHECKPOINT = os.environ.get('BACKFILL_CHECKPOINT', '.embedding_backfill.checkpoint')
+
+UPSERT_EMBEDDINGS = """
+    INSERT INTO embeddings (sku, vec, dims, model, content_hash)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        vec = VALUES(vec), dims = VALUES(dims), model = VALUES(model), content_hash = VALUES(content_hash)
+"""
+
+
+def embedding_text(name, searchable_text):
+    """Combine name and searchable_text for embedding"""
+    return f"{name or ''} {searchable_text or ''}".strip()
+
+
+def content_hash(name, searchable_text, model_name=MODEL_NAME):
+    """Changes whenever the embedded text or the model does"""
+    digest = hashlib.sha1()
+    for part in (model_name, name or '', searchable_text or ''):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def encode_rows(model, pending, batch_size):
+    """Encode (sku, text, hash) tuples in one batch; returns upsert rows"""
+    embeddings = model.encode([text for _, text, _ in pending], batch_size=batch_size, convert_to_numpy=True)
+    return [
+        (sku, embedding.astype('float32').tobytes(), embedding.shape[0], MODEL_NAME, digest)
+        for (sku, _, digest), embedding in zip(pending, embeddings)
+    ]
+
+
+def generate_embeddings(batch_size=EMBEDDING_BATCH_SIZE, force=False):
+    """
+    Embed products whose name / searchable_text (or the model) changed since
+    their embedding was written. Pass force=True to re-embed everything.
+    """
+    ensure_schema()
     cnx = get_db_connection()
     cursor = cnx.cursor(dictionary=True)
-    
+
     try:
-        # Fetch all products
-        cursor.execute("SELECT sku, name, searchable_text FROM products")
+        # Fetch all products with the hash of their current embedding
+        cursor.execute("""
+            SELECT p.sku, p.name, p.searchable_text, e.content_hash
+            FROM products p
+            LEFT JOIN embeddings e ON e.sku = p.sku
+        """)
         products = cursor.fetchall()
-        
-        print(f"Found {len(products)} products to process...")
-        
-        for idx, product in enumerate(products):
+
+        print(f"Found {len(products)} products...")
+
+        pending = []
+        for product in products:
             sku = product['sku']
-            name = product['name'] or ''
-            searchable_text = product['searchable_text'] or ''
-            
-            # Combine name and searchable_text for embedding
-            text = f"{name} {searchable_text}".strip()
-            
+            text = embedding_text(product['name'], product['searchable_text'])
             if not text:
                 print(f"Skipping {sku} - no text content")
                 continue
-            
-            # Generate embedding
-            embedding = model.encode(text, convert_to_numpy=True)
-            embedding_bytes = embedding.tobytes()
-            embedding_dim = embedding.shape[0]
-            model_name = 'all-MiniLM-L6-v2'
-            
-            # Check if embedding already exists
-            cursor.execute("SELECT sku FROM embeddings WHERE sku = %s", (sku,))
-            exists = cursor.fetchone()
-            
-            if exists:
-                # Update existing embedding
-                cursor.execute("""
-                    UPDATE embeddings
-                    SET vec = %s, dims = %s, model = %s
-                    WHERE sku = %s
-                """, (embedding_bytes, embedding_dim, model_name, sku))
-            else:
-                # Insert new embedding
-                cursor.execute("""
-                    INSERT INTO embeddings (sku, vec, dims, model)
-                    VALUES (%s, %s, %s, %s)
-                """, (sku, embedding_bytes, embedding_dim, model_name))
-            
-            if (idx + 1) % 10 == 0:
-                print(f"Processed {idx + 1}/{len(products)} products...")
-                cnx.commit()
-        
-        cnx.commit()
-        print(f"✅ Successfully generated embeddings for {len(products)} products!")
-        
+            digest = content_hash(product['name'], product['searchable_text'])
+            if force or digest != product['content_hash']:
+                pending.append((sku, text, digest))
+
+        print(f"{len(pending)} products need new embeddings ({len(products) - len(pending)} unchanged or empty)")
+        if not pending:
+            export_snapshot()
+            return 0
+
+        model = load_model(warmup=False)
+        start = time.perf_counter()
+        for offset in range(0, len(pending), batch_size):
+            batch = pending[offset:offset + batch_size]
+            cursor.executemany(UPSERT_EMBEDDINGS, encode_rows(model, batch, batch_size))
+            cnx.commit()
+
+            done = offset + len(batch)
+            rate = done / (time.perf_counter() - start)
+            print(f"Processed {done}/{len(pending)} products ({rate:.1f}/s)...")
+
+        print(f"✅ Successfully generated embeddings for {len(pending)} products!")
+        export_snapshot()
+        return len(pending)
+
     except Exception as e:
         print(f"❌ Error: {e}")
         cnx.rollback()
@@ -75,5 +114,223 @@ def generate_embeddings():
         cursor.close()
         cnx.close()
 
+# --- Streaming, multi-process backfill ---
+_worker_model = None
+
+
+def _init_worker(threads):
+    """Each encoding process loads its own model copy"""
+    global _worker_model
+    import torch
+    torch.set_num_threads(threads)
+    _worker_model = load_model(warmup=False)
+
+
+def _encode_chunk(pending, batch_size):
+    return encode_rows(_worker_model, pending, batch_size)
+
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return f.read().strip() or None
+
+
+def write_checkpoint(path, sku):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(sku)
+    os.replace(tmp, path)
+
+
+class BackfillWriter(threading.Thread):
+    """
+    Single writer: upserts encoded chunks in the order they were read, then
+    records the chunk's last SKU as the resume point. The queue is bounded so
+    a slow database applies backpressure to reading and encoding.
+    """
+
+    def __init__(self, checkpoint_path, total, max_pending):
+        super().__init__(name='embedding-writer', daemon=True)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.checkpoint_path = checkpoint_path
+        self.total = total
+        self.seen = 0
+        self.written = 0
+        self.error = None
+        self.start_time = time.perf_counter()
+
+    def put(self, item):
+        while True:
+            if self.error:
+                raise self.error
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        cnx = get_db_connection()
+        cursor = cnx.cursor()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                rows, last_sku, seen = item
+                if rows:
+                    cursor.executemany(UPSERT_EMBEDDINGS, rows)
+                    cnx.commit()
+                write_checkpoint(self.checkpoint_path, last_sku)
+                self.seen += seen
+                self.written += len(rows)
+                self.report()
+        except Exception as e:
+            self.error = e
+            cnx.rollback()
+        finally:
+            cursor.close()
+            cnx.close()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start_time
+        rate = self.seen / elapsed if elapsed else 0.0
+        eta = (self.total - self.seen) / rate if rate else 0.0
+        print(f"Backfill {self.seen}/{self.total} products, {self.written} embedded "
+              f"({rate:.1f} products/s, {self.written / elapsed if elapsed else 0.0:.1f} embeddings/s, "
+              f"ETA {eta:.0f}s)")
+
+
+def backfill(workers=BACKFILL_WORKERS, chunk_size=BACKFILL_CHUNK_SIZE, batch_size=EMBEDDING_BATCH_SIZE,
+             force=False, checkpoint_path=BACKFILL_CHECKPOINT):
+    """
+    Rebuild embeddings for large catalogs: products are streamed in SKU order
+    from an unbuffered cursor, encoded by a pool of processes (one model copy
+    each) and written by a single writer. Resumes after the SKU recorded in
+    `checkpoint_path`; the checkpoint is removed once the run completes.
+    """
+    ensure_schema()
+    last_sku = read_checkpoint(checkpoint_path)
+    if last_sku:
+        print(f"Resuming backfill after SKU {last_sku}")
+
+    cnx = get_db_connection()
+    cursor = cnx.cursor(dictionary=True)
+    cursor.execute("SELECT COUNT(*) AS n FROM products WHERE sku > %s", (last_sku or '',))
+    total = cursor.fetchone()['n']
+    cursor.close()
+
+    max_inflight = workers * 2
+    writer = BackfillWriter(checkpoint_path, total, max_inflight)
+    writer.start()
+
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(threads,)
+    )
+    inflight = deque()
+
+    def hand_off_oldest():
+        future, chunk_last_sku, seen = inflight.popleft()
+        rows = future.result() if future else []
+        writer.put((rows, chunk_last_sku, seen))
+
+    # Unbuffered (streaming) cursor: rows arrive as they're fetched
+    cursor = cnx.cursor(dictionary=True, buffered=False)
+    try:
+        print(f"Backfilling {total} products with {workers} workers...")
+        cursor.execute("""
+            SELECT p.sku, p.name, p.searchable_text, e.content_hash
+            FROM products p
+            LEFT JOIN embeddings e ON e.sku = p.sku
+            WHERE p.sku > %s
+            ORDER BY p.sku
+        """, (last_sku or '',))
+
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            if not chunk:
+                break
+            pending = []
+            for product in chunk:
+                text = embedding_text(product['name'], product['searchable_text'])
+                digest = content_hash(product['name'], product['searchable_text'])
+                if text and (force or digest != product['content_hash']):
+                    pending.append((product['sku'], text, digest))
+
+            future = pool.submit(_encode_chunk, pending, batch_size) if pending else None
+            inflight.append((future, chunk[-1]['sku'], len(chunk)))
+            # Keep a bounded number of chunks encoding; hand them to the writer in read order
+            while len(inflight) > max_inflight:
+                hand_off_oldest()
+
+        while inflight:
+            hand_off_oldest()
+        writer.put(None)
+        writer.join()
+        if writer.error:
+            raise writer.error
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        print(f"✅ Backfill complete: {writer.written} embeddings written for {writer.seen} products")
+        export_snapshot()
+
+    finally:
+        pool.shutdown(cancel_futures=True)
+        try:
+            # If the run stopped partway, discard the unread rows so closing
+            # the stream neither masks the real error with "Unread result
+            # found" nor returns the connection to the pool mid-result
+            cnx.consume_results()
+            cursor.close()
+        except mysql.connector.Error as e:
+            print(f"Could not close the backfill stream cleanly: {e}")
+        cnx.close()
+
+# --- Snapshot export ---
+def export_snapshot(directory=embedding_snapshot.EMBEDDING_SNAPSHOT_DIR):
+    """
+    Write the normalized embedding matrix as a memory-mappable snapshot for
+    the search workers. Skipped when the current snapshot is still fresh.
+    """
+    if not directory:
+        return None
+    cnx = get_db_connection()
+    cursor = cnx.cursor()
+    try:
+        marker = read_marker(cursor)
+        if embedding_snapshot.is_fresh(embedding_snapshot.read_header(directory), marker):
+            print("Embedding snapshot is up to date")
+            return None
+        cursor.execute("SELECT sku, vec FROM embeddings WHERE vec IS NOT NULL")
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        cnx.close()
+
+    skus, matrix = build_matrix(rows)
+    return embedding_snapshot.write_snapshot(skus, matrix, marker, directory)
+
 if __name__ == "__main__":
-    generate_embeddings()
+    parser = argparse.ArgumentParser(description="Generate product embeddings")
+    parser.add_argument('--batch-size', type=int, default=EMBEDDING_BATCH_SIZE)
+    parser.add_argument('--force', action='store_true', help='re-embed every product, not just changed ones')
+    parser.add_argument('--backfill', action='store_true', help='stream the catalog and encode with a process pool')
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS)
+    parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE)
+    parser.add_argument('--checkpoint', default=BACKFILL_CHECKPOINT)
+    parser.add_argument('--export-snapshot', action='store_true', help='only write the search snapshot')
+    args = parser.parse_args()
+    if args.export_snapshot:
+        export_snapshot()
+    elif args.backfill:
+        backfill(workers=args.workers, chunk_size=args.chunk_size, batch_size=args.batch_size,
+                 force=args.force, checkpoint_path=args.checkpoint)
+    else:
+        generate_embeddings(batch_size=args.batch_size, force=args.force)
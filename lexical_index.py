@@ -0,0 +1,331 @@
+"""
+In-memory lexical index over the product catalog for the keyword leg.
+
+Tokens from name, brand, SKU and searchable_text (lowercased, accents
+folded) go into an inverted index scored with BM25. Every query term must
+match (posting-list intersection); the last term also matches as a prefix,
+as MySQL's `term*` did. If no product has every term, any-term matches are
+returned instead. Substring matches on SKU (via a trigram index) and brand
+replace the `LIKE '%q%'` scans.
+
+Scores are divided by the best score of the query, so they land in [0, 1]
+like the vector leg's. The index is rebuilt whenever the product cache sees
+a catalog change.
+"""
+import bisect
+import os
+import re
+import time
+import unicodedata
+from collections import Counter, defaultdict
+import numpy as np
+
+import metrics
+import product_cache
+from ann_index import top_k
+from db import get_connection
+
+# Set LEXICAL_INDEX=0 to keep the keyword leg on MySQL FULLTEXT
+LEXICAL_INDEX = os.environ.get('LEXICAL_INDEX', '1') != '0'
+# Vocabulary terms a trailing query prefix may expand to
+LEXICAL_PREFIX_EXPANSIONS = int(os.environ.get('LEXICAL_PREFIX_EXPANSIONS', '64'))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Normalized score of a product matched only by a SKU or brand substring
+SUBSTRING_SCORE = 0.25
+# An exact SKU hit outranks every BM25 match (reported as 1.0)
+EXACT_SKU_SCORE = 1.0 + 1e-6
+
+_TOKEN = re.compile(r'[a-z0-9]+')
+_EMPTY = (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32))
+
+
+def normalize(text):
+    """Lowercase and fold accents ('Grifería' -> 'griferia')"""
+    return unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode('ascii').lower()
+
+
+def tokenize(text):
+    return _TOKEN.findall(normalize(text))
+
+
+def _compact(text):
+    return ''.join(normalize(text).split())
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class AttributeMasks:
+    """
+    Boolean row masks for search filters (see search_filters) over aligned
+    brand, category and price arrays. Brand and category match ignoring case
+    and accents; the mask for each value is computed on first use and kept.
+    """
+
+    def __init__(self, brands, categories, prices):
+        self._codes = {}
+        self._lookup = {}
+        for field, values in (('brand', brands), ('category', categories)):
+            lookup = {}
+            self._codes[field] = np.fromiter(
+                (lookup.setdefault(normalize(value), len(lookup)) if value else -1 for value in values),
+                dtype=np.int32, count=len(values)
+            )
+            self._lookup[field] = lookup
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self._masks = {}
+
+    def _value_mask(self, field, value):
+        key = (field, normalize(value))
+        mask = self._masks.get(key)
+        if mask is None:
+            code = self._lookup[field].get(key[1])
+            mask = self._codes[field] == code if code is not None else np.zeros(len(self.prices), dtype=bool)
+            self._masks[key] = mask
+        return mask
+
+    def mask(self, filters):
+        mask = np.ones(len(self.prices), dtype=bool)
+        if filters.brand:
+            mask &= self._value_mask('brand', filters.brand)
+        if filters.category:
+            mask &= self._value_mask('category', filters.category)
+        if filters.min_price is not None:
+            mask &= self.prices >= filters.min_price
+        if filters.max_price is not None:
+            mask &= self.prices <= filters.max_price
+        return mask
+
+
+class LexicalIndex:
+    """An immutable index over one load of the catalog"""
+
+    def __init__(self, rows, version=0):
+        self.version = version
+        self.skus = [row['sku'] for row in rows]
+        self.names = [row['name'] for row in rows]
+        self.brands = [row['brand'] for row in rows]
+        self.categories = [row['category'] for row in rows]
+        self.prices = np.array([float(row['unit_price']) for row in rows], dtype=np.float64)
+
+        postings = defaultdict(dict)
+        lengths = np.zeros(len(rows), dtype=np.float32)
+        for doc, row in enumerate(rows):
+            text = ' '.join(filter(None, (row['name'], row['brand'], row['sku'], row['searchable_text'])))
+            tokens = tokenize(text)
+            lengths[doc] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                postings[term][doc] = tf
+
+        # Posting lists are sorted by doc id, so they intersect with intersect1d
+        self.postings = {
+            term: (np.fromiter(docs.keys(), dtype=np.int32, count=len(docs)),
+                   np.fromiter(docs.values(), dtype=np.float32, count=len(docs)))
+            for term, docs in postings.items()
+        }
+        self.terms = sorted(self.postings)
+        avg_length = float(lengths.mean()) if len(lengths) else 1.0
+        self._length_norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(avg_length, 1.0))
+
+        self._sku_docs = {}
+        self._sku_keys = []
+        sku_trigrams = defaultdict(list)
+        for doc, sku in enumerate(self.skus):
+            key = _compact(sku)
+            self._sku_docs.setdefault(key, doc)
+            self._sku_keys.append(key)
+            for gram in _trigrams(key):
+                sku_trigrams[gram].append(doc)
+        self._sku_trigrams = {gram: np.array(docs, dtype=np.int32) for gram, docs in sku_trigrams.items()}
+
+        brand_docs = defaultdict(list)
+        for doc, brand in enumerate(self.brands):
+            if brand:
+                brand_docs[normalize(brand)].append(doc)
+        self._brand_docs = {brand: np.array(docs, dtype=np.int32) for brand, docs in brand_docs.items()}
+        self.masks = AttributeMasks(self.brands, self.categories, self.prices)
+
+    def __len__(self):
+        return len(self.skus)
+
+    def _term(self, term):
+        """(docs, BM25 scores) for one vocabulary term"""
+        docs, tf = self.postings.get(term, _EMPTY)
+        if not len(docs):
+            return _EMPTY
+        idf = np.log(1.0 + (len(self) - len(docs) + 0.5) / (len(docs) + 0.5))
+        return docs, (idf * tf * (BM25_K1 + 1) / (tf + self._length_norm[docs])).astype(np.float32)
+
+    def _prefix(self, prefix):
+        """(docs, scores) for all terms starting with `prefix`, best expansion per doc"""
+        start = bisect.bisect_left(self.terms, prefix)
+        parts = []
+        for term in self.terms[start:start + LEXICAL_PREFIX_EXPANSIONS]:
+            if not term.startswith(prefix):
+                break
+            parts.append(self._term(term))
+        if not parts:
+            return _EMPTY
+        if len(parts) == 1:
+            return parts[0]
+        return self._dedupe(np.concatenate([d for d, _ in parts]), np.concatenate([s for _, s in parts]))
+
+    def _bm25(self, tokens):
+        """Docs matching every token (the last as a prefix), else any token"""
+        groups = [self._term(token) for token in tokens[:-1]] + [self._prefix(tokens[-1])]
+        docs, scores = groups[0]
+        for group_docs, group_scores in groups[1:]:
+            docs, left, right = np.intersect1d(docs, group_docs, assume_unique=True, return_indices=True)
+            scores = scores[left] + group_scores[right]
+        if len(docs) or len(groups) == 1:
+            return docs, scores
+
+        docs = np.concatenate([d for d, _ in groups])
+        if not len(docs):
+            return _EMPTY
+        docs, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate([s for _, s in groups])).astype(np.float32)
+        return docs, scores
+
+    def _dedupe(self, docs, scores):
+        """Keep the best score per doc"""
+        order = np.lexsort((-scores, docs))
+        docs, scores = docs[order], scores[order]
+        first = np.concatenate([[True], docs[1:] != docs[:-1]])
+        return docs[first], scores[first]
+
+    def _substring(self, query):
+        """Docs whose SKU or brand contains the query"""
+        compact = _compact(query)
+        found = []
+        if len(compact) >= 3:
+            grams = sorted(_trigrams(compact), key=lambda g: len(self._sku_trigrams.get(g, ())))
+            candidates = self._sku_trigrams.get(grams[0], _EMPTY[0])
+            for gram in grams[1:]:
+                if not len(candidates):
+                    break
+                candidates = np.intersect1d(candidates, self._sku_trigrams.get(gram, _EMPTY[0]),
+                                            assume_unique=True)
+            found.extend(int(doc) for doc in candidates if compact in self._sku_keys[doc])
+        needle = ' '.join(normalize(query).split())
+        if needle:
+            for brand, docs in self._brand_docs.items():
+                if needle in brand:
+                    found.extend(docs.tolist())
+        return found
+
+    def search(self, query, limit=20, filters=None):
+        """
+        Top `limit` products for a keyword query, as dicts with sku, name,
+        brand, unit_price and bm25_score (normalized to [0, 1]), best first.
+        Only products passing `filters` (a SearchFilters) are returned.
+        """
+        tokens = tokenize(query)
+        if not tokens or limit <= 0:
+            return []
+
+        docs, scores = self._bm25(tokens)
+        extra = self._substring(query)
+        exact = self._sku_docs.get(_compact(query))
+        if filters is not None:
+            allowed = self.masks.mask(filters)
+            keep = allowed[docs]
+            docs, scores = docs[keep], scores[keep]
+            extra = [doc for doc in extra if allowed[doc]]
+            if exact is not None and not allowed[exact]:
+                exact = None
+        if len(docs):
+            scores = scores / scores.max()
+
+        if extra or exact is not None:
+            extra_scores = [SUBSTRING_SCORE] * len(extra)
+            if exact is not None:
+                extra.append(exact)
+                extra_scores.append(EXACT_SKU_SCORE)
+            docs, scores = self._dedupe(
+                np.concatenate([docs, np.array(extra, dtype=np.int32)]),
+                np.concatenate([scores, np.array(extra_scores, dtype=np.float32)]),
+            )
+
+        best = top_k(scores, limit)
+        ranked = zip(docs[best].tolist(), scores[best].tolist())
+        return [
+            {
+                'sku': self.skus[doc],
+                'name': self.names[doc],
+                'brand': self.brands[doc],
+                'unit_price': float(self.prices[doc]),
+                'bm25_score': min(score, 1.0),
+            }
+            for doc, score in ranked
+        ]
+
+
+_index = None
+_started = False
+
+
+def load_catalog():
+    """All products with the columns the index is built from"""
+    cnx = get_connection()
+    cursor = cnx.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT sku, name, brand, category, unit_price, searchable_text FROM products")
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+        cnx.close()
+
+
+def rebuild():
+    """Build a new index from the products table and swap it in"""
+    global _index
+    start = time.perf_counter()
+    rows = load_catalog()
+    index = LexicalIndex(rows, (_index.version + 1) if _index is not None else 1)
+    _index = index
+    metrics.observe('lexical_build', time.perf_counter() - start)
+    print(f"Lexical index built over {len(index)} products in {time.perf_counter() - start:.2f}s "
+          f"({len(index.terms)} terms)")
+    return index
+
+
+def start():
+    """Build the index now and rebuild it in the background after catalog changes"""
+    global _started
+    if not LEXICAL_INDEX or _started:
+        return
+    _started = True
+    changed = product_cache.rebuild_on_change('Lexical index', rebuild)
+    try:
+        rebuild()
+    except Exception as e:
+        print(f"Lexical index build failed, retrying in the background: {e}")
+        changed.set()
+
+
+def get_lexical_index():
+    """The current index, or None if it isn't enabled or hasn't been built"""
+    return _index if LEXICAL_INDEX else None
+
+
+def version():
+    return _index.version if _index is not None else 0
+
+
+def search(query, limit=20, filters=None):
+    """Search the current index; None if there is no index to search"""
+    index = get_lexical_index()
+    if index is None:
+        return None
+    return index.search(query, limit, filters)
+
+
+def stats():
+    index = get_lexical_index()
+    if index is None:
+        return {'enabled': LEXICAL_INDEX, 'products': 0, 'terms': 0, 'version': 0}
+    return {'enabled': True, 'products': len(index), 'terms': len(index.terms), 'version': index.version}
@@ -0,0 +1,224 @@
+"""
+Low-overhead stage timers and counters, exposed in Prometheus text format.
+
+    with metrics.stage('encode'):
+        vec = model.encode(text)
+
+Each stage feeds a process-wide histogram and, when called while a request
+is being served, that request's timings, which app.py sends back as a
+Server-Timing header. Request timings live in a contextvar; code that hands
+work to other threads must run it in a copy of the caller's context
+(contextvars.copy_context().run) for its stages to be attributed.
+
+Metrics are per process: with several uvicorn workers each one reports its
+own, so scrape them individually or aggregate by instance.
+"""
+import bisect
+import contextvars
+import functools
+import os
+import threading
+import time
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+
+# Histogram bucket upper bounds, in seconds
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets for per-request DB query counts
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+
+class Histogram:
+    """Fixed-bucket histogram; counts are per bucket and cumulated on render"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class RequestTimings:
+    """Stage durations and DB queries accumulated while serving one request"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.queries = 0
+        self.query_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_query(self, seconds):
+        with self._lock:
+            self.queries += 1
+            self.query_seconds += seconds
+
+    def server_timing(self):
+        """Server-Timing header value: one entry per stage, DB time and the total"""
+        with self._lock:
+            parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items()]
+            if self.queries:
+                parts.append(f'db;desc="{self.queries} queries";dur={self.query_seconds * 1000:.2f}')
+        parts.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.2f}")
+        return ', '.join(parts)
+
+
+_current = contextvars.ContextVar('request_timings', default=None)
+_lock = threading.Lock()
+_stages = {}             # stage name -> Histogram
+_requests = {}           # (method, route) -> Histogram of request duration
+_request_queries = {}    # (method, route) -> Histogram of DB queries per request
+_named = {}              # metric name -> (help text, Histogram) from histogram()
+_counters = {'db_queries': 0, 'db_query_seconds': 0.0}
+
+
+def _histogram(registry, key, buckets):
+    histogram = registry.get(key)
+    if histogram is None:
+        with _lock:
+            histogram = registry.setdefault(key, Histogram(buckets))
+    return histogram
+
+
+def histogram(name, help_text, buckets):
+    """A standalone histogram rendered as `name`, for values other than stage times"""
+    entry = _named.get(name)
+    if entry is None:
+        with _lock:
+            entry = _named.setdefault(name, (help_text, Histogram(buckets)))
+    return entry[1]
+
+
+def observe(name, seconds):
+    """Record `seconds` spent in stage `name`"""
+    if not METRICS_ENABLED:
+        return
+    _histogram(_stages, name, STAGE_BUCKETS).observe(seconds)
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+class stage:
+    """Context manager timing a block as stage `name`"""
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+
+
+def timed(name):
+    """Decorator timing every call of a function as stage `name`"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def record_query(seconds):
+    """Count one DB statement taking `seconds`"""
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        _counters['db_queries'] += 1
+        _counters['db_query_seconds'] += seconds
+    timings = _current.get()
+    if timings is not None:
+        timings.add_query(seconds)
+
+
+def begin_request():
+    """Start collecting timings for the request served in this context"""
+    timings = RequestTimings()
+    _current.set(timings)
+    return timings
+
+
+def end_request(timings, method, route):
+    """Record a finished request's duration and query count under its route"""
+    if not METRICS_ENABLED:
+        return
+    key = (method, route)
+    _histogram(_requests, key, STAGE_BUCKETS).observe(time.perf_counter() - timings.start)
+    _histogram(_request_queries, key, QUERY_COUNT_BUCKETS).observe(timings.queries)
+
+
+# --- Prometheus text format ---
+
+def _labels(**labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels.items())
+
+
+def _render_histogram(lines, name, help_text, registry):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in sorted(registry.items()):
+        counts, total, count = histogram.snapshot()
+        prefix = labels + ',' if labels else ''
+        suffix = '{' + labels + '}' if labels else ''
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {count}')
+        lines.append(f"{name}_sum{suffix} {total}")
+        lines.append(f"{name}_count{suffix} {count}")
+
+
+def _render_metric(lines, name, kind, help_text, value):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    lines.append(f"{name} {value}")
+
+
+def render(extra=()):
+    """
+    All metrics in Prometheus text exposition format. `extra` adds
+    (name, 'counter' or 'gauge', help text, value) entries owned elsewhere,
+    e.g. connection pool state.
+    """
+    lines = []
+    _render_histogram(lines, 'app_stage_seconds', 'Time spent in each request stage.',
+                      {_labels(stage=name): h for name, h in list(_stages.items())})
+    _render_histogram(lines, 'app_request_seconds', 'Request duration by route.',
+                      {_labels(method=m, route=r): h for (m, r), h in list(_requests.items())})
+    _render_histogram(lines, 'app_request_db_queries', 'Database statements executed per request.',
+                      {_labels(method=m, route=r): h for (m, r), h in list(_request_queries.items())})
+    for name, (help_text, named) in sorted(_named.items()):
+        _render_histogram(lines, name, help_text, {'': named})
+    with _lock:
+        counters = dict(_counters)
+    _render_metric(lines, 'app_db_queries_total', 'counter', 'Database statements executed.',
+                   counters['db_queries'])
+    _render_metric(lines, 'app_db_query_seconds_total', 'counter', 'Time spent executing database statements.',
+                   counters['db_query_seconds'])
+    for name, kind, help_text, value in extra:
+        _render_metric(lines, name, kind, help_text, value)
+    return '\n'.join(lines) + '\n'
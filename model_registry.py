@@ -0,0 +1,135 @@
+import os
+import threading
+import time
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+import metrics
+from cache import LRUCache
+from encode_batcher import ENCODE_BATCH_WINDOW, EncodeBatcher
+
+# Embedding model shared by search and embedding generation
+MODEL_NAME = os.environ.get('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+
+# Representative queries encoded once after loading so the first real
+# request doesn't pay for lazy initialization inside torch
+WARMUP_TEXTS = [
+    "mosaico",
+    "porcelanato 60x60",
+    "grifería cocina",
+    "9069/CR",
+]
+
+# Encoded query vectors, keyed on (model name, whitespace-normalized text)
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', '20000'))
+
+_models = {}
+_batchers = {}
+_lock = threading.Lock()
+_query_cache = LRUCache(QUERY_CACHE_SIZE)
+
+
+def load_model(name=MODEL_NAME, warmup=True):
+    """Load a model into the registry (once) and optionally warm it up"""
+    with _lock:
+        model = _models.get(name)
+        if model is None:
+            print(f"Loading embedding model {name}...")
+            start = time.perf_counter()
+            model = SentenceTransformer(name)
+            metrics.observe('model_load', time.perf_counter() - start)
+            print(f"Loaded {name} in {time.perf_counter() - start:.2f}s")
+            if warmup:
+                warmup_model(model)
+            _models[name] = model
+    return model
+
+
+def warmup_model(model):
+    """Run a few encodes so kernels and tokenizer caches are initialized"""
+    start = time.perf_counter()
+    for text in WARMUP_TEXTS:
+        model.encode(text, convert_to_numpy=True)
+    model.encode(WARMUP_TEXTS, convert_to_numpy=True)
+    print(f"Warmed up embedding model in {time.perf_counter() - start:.2f}s")
+
+
+def get_model(name=MODEL_NAME):
+    """Return the shared model handle, loading it on first use"""
+    model = _models.get(name)
+    if model is None:
+        model = load_model(name)
+    return model
+
+
+def get_batcher(name=MODEL_NAME):
+    """The shared EncodeBatcher for a model, started on first use"""
+    batcher = _batchers.get(name)
+    if batcher is None:
+        model = get_model(name)
+        with _lock:
+            batcher = _batchers.get(name)
+            if batcher is None:
+                batcher = EncodeBatcher(
+                    lambda texts: model.encode(texts, convert_to_numpy=True, batch_size=len(texts)),
+                    name=f"encode-{name}",
+                )
+                _batchers[name] = batcher
+    return batcher
+
+
+def encode_query(text, name=MODEL_NAME):
+    """
+    Encode a search query, reusing the cached vector for repeated queries.
+    Cache misses from concurrent requests are encoded together in
+    micro-batches (see encode_batcher) unless ENCODE_BATCH_WINDOW_MS=0.
+    Only whitespace is normalized, since case may matter to other models.
+    The returned array is shared and read-only.
+    """
+    key = (name, ' '.join(text.split()))
+    vec = _query_cache.get(key)
+    if vec is None:
+        if ENCODE_BATCH_WINDOW > 0:
+            # The batcher records encode (its model call) and encode_queue
+            vec = get_batcher(name).encode(key[1])
+        else:
+            model = get_model(name)
+            with metrics.stage('encode'):
+                vec = model.encode(key[1], convert_to_numpy=True)
+        vec.setflags(write=False)
+        _query_cache.put(key, vec)
+    return vec
+
+
+def encode_queries(texts, name=MODEL_NAME):
+    """
+    encode_query() for a list of texts: cached vectors are reused and the
+    misses are encoded in a single model call. Returns a (len(texts), dims)
+    array.
+    """
+    keys = [(name, ' '.join(text.split())) for text in texts]
+    vectors = {key: _query_cache.get(key) for key in keys}
+    missing = [key for key, vec in vectors.items() if vec is None]
+    if missing:
+        model = get_model(name)
+        with metrics.stage('encode'):
+            encoded = model.encode([key[1] for key in missing], convert_to_numpy=True,
+                                   batch_size=len(missing))
+        for key, row in zip(missing, encoded):
+            # A copy, so a cached vector doesn't keep the whole batch alive
+            vec = row.copy()
+            vec.setflags(write=False)
+            _query_cache.put(key, vec)
+            vectors[key] = vec
+    return np.stack([vectors[key] for key in keys])
+
+
+def query_cache_stats():
+    return _query_cache.stats()
+
+
+def unload_models():
+    with _lock:
+        _models.clear()
+        _batchers.clear()
+    _query_cache.clear()
@@ -0,0 +1,71 @@
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+
+from db import get_connection
+
+# Seconds a loaded pricing config is served before it's re-read
+PRICING_CONFIG_REFRESH = float(os.environ.get('PRICING_CONFIG_REFRESH', '30'))
+
+# `version` identifies the exact values; it's stored on every quote priced with them
+PricingConfig = namedtuple('PricingConfig', 'transfer_discount installments_markup version loaded_at')
+
+_config = None
+_lock = threading.Lock()
+
+
+def _version(transfer_discount, installments_markup):
+    digest = hashlib.sha1(f"{transfer_discount!r}|{installments_markup!r}".encode('ascii'))
+    return digest.hexdigest()[:12]
+
+
+def reload():
+    """Read config_pricing now and make it the current config"""
+    global _config
+    cnx = get_connection()
+    cursor = cnx.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT transfer_discount, installments_markup FROM config_pricing WHERE id = 1")
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+        cnx.close()
+    if not row:
+        raise RuntimeError("Pricing config not found in the database.")
+
+    transfer_discount = float(row['transfer_discount'])
+    installments_markup = float(row['installments_markup'])
+    config = PricingConfig(
+        transfer_discount,
+        installments_markup,
+        _version(transfer_discount, installments_markup),
+        time.time()
+    )
+    if _config is None or _config.version != config.version:
+        print(f"Pricing config version {config.version} loaded")
+    _config = config
+    return config
+
+
+def get_pricing_config():
+    """
+    Return the current pricing config, re-reading it once it's older than
+    PRICING_CONFIG_REFRESH seconds. If a refresh fails, the last good config
+    keeps being served.
+    """
+    config = _config
+    if config is not None and time.time() - config.loaded_at < PRICING_CONFIG_REFRESH:
+        return config
+    with _lock:
+        config = _config
+        if config is not None and time.time() - config.loaded_at < PRICING_CONFIG_REFRESH:
+            return config
+        try:
+            return reload()
+        except Exception as e:
+            if config is None:
+                raise
+            print(f"Pricing config refresh failed, keeping version {config.version}: {e}")
+            return config
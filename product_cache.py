@@ -0,0 +1,176 @@
+import os
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+from cache import LRUCache
+from db import get_connection
+
+PRODUCT_CACHE_SIZE = int(os.environ.get('PRODUCT_CACHE_SIZE', '50000'))
+# How often (seconds) the products change marker is polled
+PRODUCT_CACHE_POLL_INTERVAL = float(os.environ.get('PRODUCT_CACHE_POLL_INTERVAL', '5'))
+
+# Compact per-SKU record; tuples are far smaller than row dicts
+ProductRecord = namedtuple('ProductRecord', 'sku name brand category unit_price')
+
+_cache = LRUCache(PRODUCT_CACHE_SIZE)
+_marker = None           # (MAX(updated_at), deletes counter) when last checked
+_last_check = 0.0
+_check_lock = threading.Lock()
+_watching = False
+_listeners = []          # called after each detected catalog change
+version = 0              # bumped whenever cached products may have changed
+
+
+def _record(row):
+    return ProductRecord(row['sku'], row['name'], row['brand'], row['category'], float(row['unit_price']))
+
+
+def get_products(skus):
+    """
+    Return {sku: ProductRecord} for the given SKUs. Cached products are served
+    from memory; the rest are fetched with a single IN query. Unknown SKUs are
+    left out of the result.
+    """
+    maybe_check_for_changes()
+    found = {}
+    missing = []
+    for sku in dict.fromkeys(skus):
+        record = _cache.get(sku)
+        if record is None:
+            missing.append(sku)
+        else:
+            found[sku] = record
+
+    if missing:
+        loaded_version = version
+        with metrics.stage('product_fetch'):
+            cnx = get_connection()
+            cursor = cnx.cursor(dictionary=True)
+            try:
+                placeholders = ','.join(['%s'] * len(missing))
+                cursor.execute(
+                    f"SELECT sku, name, brand, category, unit_price FROM products WHERE sku IN ({placeholders})",
+                    missing
+                )
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+                cnx.close()
+
+        for row in rows:
+            record = _record(row)
+            # Don't cache rows read before an invalidation that ran meanwhile
+            if version == loaded_version:
+                _cache.put(record.sku, record)
+            found[record.sku] = record
+
+    return found
+
+
+def get_product(sku):
+    """Return the ProductRecord for a SKU, or None if it doesn't exist"""
+    return get_products([sku]).get(sku)
+
+
+def check_for_changes():
+    """
+    Poll the products change marker: MAX(updated_at) (an index lookup) and
+    the deletes counter a trigger keeps in catalog_version (see schema).
+    Products inserted or updated since the last check are evicted; if any
+    were deleted the whole cache is dropped. Returns True if anything
+    changed.
+    """
+    global _marker, _last_check, version
+    with _check_lock:
+        cnx = get_connection()
+        cursor = cnx.cursor()
+        try:
+            cursor.execute("""
+                SELECT (SELECT MAX(updated_at) FROM products),
+                       (SELECT deletes FROM catalog_version WHERE id = 1)
+            """)
+            marker = tuple(cursor.fetchone())
+            previous = _marker
+            _last_check = time.monotonic()
+            if marker == previous:
+                return False
+
+            if previous is not None and marker[1] == previous[1] and previous[0] is not None:
+                cursor.execute("SELECT sku FROM products WHERE updated_at >= %s", (previous[0],))
+                for (sku,) in cursor.fetchall():
+                    _cache.pop(sku)
+            else:
+                _cache.clear()
+            _marker = marker
+            version += 1
+            if previous is None:
+                return False
+            for listener in _listeners:
+                listener()
+            return True
+        finally:
+            cursor.close()
+            cnx.close()
+
+
+def maybe_check_for_changes():
+    if not _watching and time.monotonic() - _last_check >= PRODUCT_CACHE_POLL_INTERVAL:
+        check_for_changes()
+
+
+def _watch():
+    while True:
+        time.sleep(PRODUCT_CACHE_POLL_INTERVAL)
+        try:
+            check_for_changes()
+        except Exception as e:
+            print(f"Product cache change check failed: {e}")
+
+
+def start_watcher():
+    """Poll the change marker in the background so requests never have to"""
+    global _watching
+    _watching = True
+    thread = threading.Thread(target=_watch, name='product-cache-watcher', daemon=True)
+    thread.start()
+    return thread
+
+
+def add_listener(callback):
+    """Call `callback()` (which must return quickly) after each catalog change"""
+    _listeners.append(callback)
+
+
+def rebuild_on_change(name, rebuild, interval=None):
+    """
+    Run `rebuild()` in a background thread after each catalog change, and
+    every `interval` seconds if given. Changes arriving during a rebuild
+    coalesce into one more; failed rebuilds are retried after a poll interval.
+    Returns the event that requests a rebuild.
+    """
+    changed = threading.Event()
+
+    def run():
+        while True:
+            changed.wait(interval)
+            changed.clear()
+            try:
+                rebuild()
+            except Exception as e:
+                print(f"{name} rebuild failed: {e}")
+                time.sleep(PRODUCT_CACHE_POLL_INTERVAL)
+                changed.set()
+
+    add_listener(changed.set)
+    threading.Thread(target=run, name=f"{name.lower().replace(' ', '-')}-rebuild", daemon=True).start()
+    return changed
+
+
+def clear():
+    _cache.clear()
+
+
+def stats():
+    return dict(_cache.stats(), version=version)
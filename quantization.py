@@ -0,0 +1,129 @@
+import os
+import numpy as np
+
+# In-memory representation of the embedding matrix used for the coarse scan:
+# 'float32' (exact), 'float16' (half the memory) or 'int8' (a quarter, with a
+# per-row scale). Quantized scans are re-scored at full precision from the
+# embedding snapshot, so quantized storage only applies when one is fresh.
+VECTOR_STORAGE = os.environ.get('VECTOR_STORAGE', 'float32')
+# Candidates re-scored at full precision per requested result
+VECTOR_RESCORE_FACTOR = int(os.environ.get('VECTOR_RESCORE_FACTOR', '4'))
+
+# Rows decoded per block when scanning, bounding the temporary float32 copy
+_CHUNK = 4096
+
+
+class QuantizedMatrix:
+    """
+    Compact stand-in for an (n, dims) float32 matrix. Supports what the
+    indexes need: len(), .shape, `matrix @ query` (scanned in decoded blocks)
+    and row indexing, which returns decoded float32 rows. `query` may be a
+    (dims, n) array of several queries. Each storage implements __getitem__
+    and with_rows() (used to apply deltas).
+    """
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __matmul__(self, query):
+        scores = np.empty((len(self),) + query.shape[1:], dtype=np.float32)
+        for start in range(0, len(self), _CHUNK):
+            scores[start:start + _CHUNK] = self[start:start + _CHUNK] @ query
+        return scores
+
+
+class Float16Matrix(QuantizedMatrix):
+    storage = 'float16'
+
+    def __init__(self, matrix):
+        self.data = np.ascontiguousarray(matrix, dtype=np.float16)
+        self.shape = self.data.shape
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __getitem__(self, ids):
+        return self.data[ids].astype(np.float32)
+
+    def with_rows(self, replace_ids, replace_rows, appended_rows):
+        """New matrix with rows `replace_ids` overwritten and `appended_rows` added"""
+        data = self.data.copy()
+        if len(replace_ids):
+            data[replace_ids] = replace_rows
+        if len(appended_rows):
+            data = np.concatenate([data, np.asarray(appended_rows, dtype=np.float16)])
+        result = Float16Matrix.__new__(Float16Matrix)
+        result.data = data
+        result.shape = data.shape
+        return result
+
+
+class Int8Matrix(QuantizedMatrix):
+    """Symmetric int8 codes with one float32 scale per row"""
+
+    storage = 'int8'
+
+    def __init__(self, matrix):
+        self.codes, self.scales = self._encode(np.asarray(matrix, dtype=np.float32))
+        self.shape = self.codes.shape
+
+    @staticmethod
+    def _encode(matrix):
+        scales = np.abs(matrix).max(axis=1) / 127.0 if len(matrix) else np.empty(0, dtype=np.float32)
+        scales = scales.astype(np.float32)
+        safe = np.where(scales == 0, 1.0, scales)
+        codes = np.clip(np.rint(matrix / safe[:, None]), -127, 127).astype(np.int8)
+        return codes, scales
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def __matmul__(self, query):
+        # Scale the per-row dot products rather than the decoded rows
+        scores = np.empty((len(self),) + query.shape[1:], dtype=np.float32)
+        for start in range(0, len(self), _CHUNK):
+            block = self.codes[start:start + _CHUNK].astype(np.float32)
+            scales = self.scales[start:start + _CHUNK]
+            scores[start:start + _CHUNK] = (block @ query) * (scales[:, None] if query.ndim == 2 else scales)
+        return scores
+
+    def __getitem__(self, ids):
+        rows = self.codes[ids].astype(np.float32)
+        scales = self.scales[ids]
+        return rows * (scales[:, None] if rows.ndim == 2 else scales)
+
+    def with_rows(self, replace_ids, replace_rows, appended_rows):
+        codes = self.codes.copy()
+        scales = self.scales.copy()
+        if len(replace_ids):
+            codes[replace_ids], scales[replace_ids] = self._encode(np.asarray(replace_rows, dtype=np.float32))
+        if len(appended_rows):
+            new_codes, new_scales = self._encode(np.asarray(appended_rows, dtype=np.float32))
+            codes = np.concatenate([codes, new_codes])
+            scales = np.concatenate([scales, new_scales])
+        result = Int8Matrix.__new__(Int8Matrix)
+        result.codes = codes
+        result.scales = scales
+        result.shape = codes.shape
+        return result
+
+
+STORAGE_TYPES = {
+    'float16': Float16Matrix,
+    'int8': Int8Matrix,
+}
+
+
+def quantize(matrix, storage=VECTOR_STORAGE):
+    """Return `matrix` in the configured storage ('float32' returns it unchanged)"""
+    if storage == 'float32':
+        return matrix
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"Unknown VECTOR_STORAGE '{storage}', expected float32, float16 or int8")
+    return STORAGE_TYPES[storage](matrix)
@@ -1,122 +1,289 @@
-import mysql.connector
 from datetime import datetime, timedelta
+from decimal import Decimal
+import hashlib
 import json
+import os
 import uuid
 
+import metrics
+import product_cache
+from cache import LRUCache
+from db import get_connection
+from pricing_config import get_pricing_config
+
+QUOTE_NOTES = ["Stock will be confirmed before fulfillment."]
+QUOTE_VALIDITY = timedelta(hours=24)
+# Quotes written per transaction by create_quotes
+QUOTE_BATCH_GROUP_SIZE = int(os.environ.get('QUOTE_BATCH_GROUP_SIZE', '50'))
+# Serialized quotes kept in memory; quotes never change after creation
+QUOTE_CACHE_SIZE = int(os.environ.get('QUOTE_CACHE_SIZE', '5000'))
+
+_quote_cache = LRUCache(QUOTE_CACHE_SIZE)
+
+
+class QuoteError(Exception):
+    """Invalid quote input: bad customer reference, line or SKU"""
+
+
+def validate_quote(customer_ref, lines):
+    """
+    Check the customer reference and line shapes (no DB access).
+    Returns the lines as (sku, qty, attrs) tuples.
+    """
+    if not customer_ref or not isinstance(customer_ref, str):
+        raise QuoteError("Customer reference must be a non-empty string.")
+    if not lines or not isinstance(lines, list):
+        raise QuoteError("Lines must be a non-empty list.")
+
+    parsed = []
+    for idx, line in enumerate(lines):
+        sku = line.get('sku')
+        qty = line.get('qty')
+        attrs = line.get('attributes') or {}
+
+        if not sku or not isinstance(sku, str):
+            raise QuoteError(f"Line {idx+1}: SKU must be a non-empty string.")
+        if not isinstance(qty, int) or isinstance(qty, bool) or qty <= 0:
+            raise QuoteError(f"Line {idx+1}: Quantity must be a positive integer.")
+        parsed.append((sku, qty, attrs))
+    return parsed
+
+
+def price_quote(customer_ref, lines, products, config):
+    """
+    Price validated (sku, qty, attrs) lines in memory against
+    {sku: ProductRecord} from the product cache and a PricingConfig.
+    Returns the quote header row and its line rows, ready to insert.
+    """
+    quote_id = 'CRQ-' + uuid.uuid4().hex[:8].upper()
+    valid_until = datetime.now() + QUOTE_VALIDITY
+
+    line_rows = []
+    list_total = 0.0
+    for idx, (sku, qty, attrs) in enumerate(lines):
+        product = products.get(sku)
+        if not product:
+            raise QuoteError(f"Line {idx+1}: Invalid SKU '{sku}' (not found in products).")
+
+        unit_price = product.unit_price
+        line_total = unit_price * qty
+        list_total += line_total
+        line_rows.append((
+            quote_id,
+            idx + 1,
+            sku,
+            product.name,
+            qty,
+            unit_price,
+            line_total,
+            json.dumps(attrs)
+        ))
+
+    header = (
+        quote_id,
+        customer_ref,
+        valid_until.strftime('%Y-%m-%d %H:%M:%S'),
+        list_total,
+        list_total * (1 - config.transfer_discount),
+        list_total * (1 + config.installments_markup),
+        json.dumps(QUOTE_NOTES),
+        config.version
+    )
+    return header, line_rows
+
+
+def insert_quotes(cursor, priced):
+    """Write priced (header, line_rows) quotes: one INSERT for headers, one batched INSERT for lines"""
+    cursor.executemany("""
+        INSERT INTO quotes (quote_id, customer_ref, valid_until, list_total, transfer_total, installments_total, notes, pricing_version)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """, [header for header, _ in priced])
+    cursor.executemany("""
+        INSERT INTO quote_lines (quote_id, line_number, sku, name, qty, unit_price, line_total, attrs)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """, [row for _, line_rows in priced for row in line_rows])
+
+
 def create_quote(customer_ref, lines):
     """
     Creates a new quote with the given customer reference and line items.
     Validates SKUs, quantities, and pricing config.
     Returns the new quote_id on success.
-    Raises Exception with a user-friendly message on failure.
+    Raises QuoteError with a user-friendly message on invalid input.
     """
-    cnx = mysql.connector.connect(
-        host='localhost',
-        user='root',
-        password='mahin1tanim2@',
-        database='casa_rom_sales'
-    )
+    with metrics.stage('quote_price'):
+        parsed = validate_quote(customer_ref, lines)
+        products = product_cache.get_products([sku for sku, _, _ in parsed])
+        header, line_rows = price_quote(customer_ref, parsed, products, get_pricing_config())
+
+    cnx = get_connection()
     cursor = cnx.cursor(dictionary=True)
 
     try:
-        cnx.start_transaction()
+        with metrics.stage('quote_write'):
+            cnx.start_transaction()
+            insert_quotes(cursor, [(header, line_rows)])
 
-        # Validate customer_ref
-        if not customer_ref or not isinstance(customer_ref, str):
-            raise Exception("Customer reference must be a non-empty string.")
+            cnx.commit()
+        return header[0]
 
-        # Validate lines
-        if not lines or not isinstance(lines, list):
-            raise Exception("Lines must be a non-empty list.")
+    except Exception:
+        cnx.rollback()
+        raise
 
-        quote_id = 'CRQ-' + uuid.uuid4().hex[:8].upper()
-        valid_until = datetime.now() + timedelta(hours=24)
+    finally:
+        cursor.close()
+        cnx.close()
 
-        # Get pricing config
-        cursor.execute("SELECT transfer_discount, installments_markup FROM config_pricing WHERE id = 1")
-        config = cursor.fetchone()
-        if not config:
-            raise Exception("Pricing config not found in the database.")
 
-        transfer_discount = float(config['transfer_discount'])
-        installments_markup = float(config['installments_markup'])
+def create_quotes(quotes, group_size=QUOTE_BATCH_GROUP_SIZE):
+    """
+    Create many quotes at once. `quotes` is a list of (customer_ref, lines).
 
-        # Insert the quote first with placeholder totals
-        cursor.execute("""
-            INSERT INTO quotes (quote_id, customer_ref, valid_until, list_total, transfer_total, installments_total, notes)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (
-            quote_id,
-            customer_ref,
-            valid_until.strftime('%Y-%m-%d %H:%M:%S'),
-            0,  # placeholder
-            0,  # placeholder
-            0,  # placeholder
-            json.dumps(["Stock will be confirmed before fulfillment."])
-        ))
+    All SKUs are priced with one shared product cache lookup and a single
+    pricing config version. Valid quotes are written `group_size` per
+    transaction; if a group fails to write, its quotes are retried one per
+    transaction so a single bad quote doesn't take the others down with it.
 
-        list_total = 0.0
-
-        # Process and insert quote lines
-        for idx, line in enumerate(lines):
-            sku = line.get('sku')
-            qty = line.get('qty')
-            attrs = line.get('attributes', {})
-
-            if not sku or not isinstance(sku, str):
-                raise Exception(f"Line {idx+1}: SKU must be a non-empty string.")
-            if not isinstance(qty, int) or qty <= 0:
-                raise Exception(f"Line {idx+1}: Quantity must be a positive integer.")
-
-            cursor.execute("SELECT unit_price, name FROM products WHERE sku = %s", (sku,))
-            product = cursor.fetchone()
-            if not product:
-                raise Exception(f"Line {idx+1}: Invalid SKU '{sku}' (not found in products).")
-
-            unit_price = float(product['unit_price'])
-            name = product['name']
-
-            line_total = unit_price * qty
-            list_total += line_total
-
-            cursor.execute("""
-                INSERT INTO quote_lines (quote_id, line_number, sku, name, qty, unit_price, line_total, attrs)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                quote_id,
-                idx + 1,
-                sku,
-                name,
-                qty,
-                unit_price,
-                line_total,
-                json.dumps(attrs)
-            ))
-
-        # Calculate totals
-        transfer_total = list_total * (1 - transfer_discount)
-        installments_total = list_total * (1 + installments_markup)
-
-        # Update the quote with the correct totals
-        cursor.execute("""
-            UPDATE quotes
-            SET list_total = %s, transfer_total = %s, installments_total = %s
-            WHERE quote_id = %s
-        """, (
-            list_total,
-            transfer_total,
-            installments_total,
-            quote_id
-        ))
+    Returns one result per input quote, in order:
+    {"success": True, "quoteId": ...} or {"success": False, "error": ...}
+    """
+    results = [None] * len(quotes)
+    parsed = {}
+    for i, (customer_ref, lines) in enumerate(quotes):
+        try:
+            parsed[i] = validate_quote(customer_ref, lines)
+        except QuoteError as e:
+            results[i] = {"success": False, "error": str(e)}
 
-        cnx.commit()
-        return quote_id
+    if not parsed:
+        return results
+
+    with metrics.stage('quote_price'):
+        products = product_cache.get_products([sku for lines in parsed.values() for sku, _, _ in lines])
+        config = get_pricing_config()
+        priced = []
+        for i, lines in parsed.items():
+            try:
+                priced.append((i, price_quote(quotes[i][0], lines, products, config)))
+            except QuoteError as e:
+                results[i] = {"success": False, "error": str(e)}
+
+    if not priced:
+        return results
+
+    cnx = get_connection()
+    cursor = cnx.cursor(dictionary=True)
+
+    try:
+        for start in range(0, len(priced), group_size):
+            group = priced[start:start + group_size]
+            try:
+                _write_group(cnx, cursor, [quote for _, quote in group])
+            except Exception as e:
+                # Isolate the failing quote(s) with one transaction per quote
+                print(f"Quote batch group failed ({e}); retrying quotes individually")
+                for i, quote in group:
+                    try:
+                        _write_group(cnx, cursor, [quote])
+                        results[i] = {"success": True, "quoteId": quote[0][0]}
+                    except Exception as e:
+                        results[i] = {"success": False, "error": str(e)}
+            else:
+                for i, quote in group:
+                    results[i] = {"success": True, "quoteId": quote[0][0]}
+
+        return results
+
+    except Exception:
+        cnx.rollback()
+        raise
+
+    finally:
+        cursor.close()
+        cnx.close()
 
-    except Exception as e:
+
+@metrics.timed('quote_write')
+def _write_group(cnx, cursor, priced):
+    cnx.start_transaction()
+    try:
+        insert_quotes(cursor, priced)
+        cnx.commit()
+    except Exception:
         cnx.rollback()
-        # Optionally, log the error here
-        raise Exception(f"Quote creation failed: {str(e)}")
+        raise
+
+
+# --- Quote Retrieval ---
+def _number(value):
+    return float(value) if isinstance(value, Decimal) else value
 
+
+@metrics.timed('quote_fetch')
+def fetch_quote(quote_id):
+    """Read a quote and its lines with one joined query; returns a dict or None"""
+    cnx = get_connection()
+    cursor = cnx.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT q.quote_id, q.customer_ref, q.valid_until, q.list_total, q.transfer_total,
+                   q.installments_total, q.notes,
+                   l.line_number, l.sku, l.name, l.qty, l.unit_price, l.line_total, l.attrs
+            FROM quotes q
+            LEFT JOIN quote_lines l ON l.quote_id = q.quote_id
+            WHERE q.quote_id = %s
+            ORDER BY l.line_number
+        """, (quote_id,))
+        rows = cursor.fetchall()
     finally:
         cursor.close()
         cnx.close()
+
+    if not rows:
+        return None
+    quote = rows[0]
+    valid_until = quote['valid_until']
+    return {
+        'quote_id': quote['quote_id'],
+        'customer_ref': quote['customer_ref'],
+        'valid_until': valid_until.isoformat() if isinstance(valid_until, datetime) else valid_until,
+        'list_total': _number(quote['list_total']),
+        'transfer_total': _number(quote['transfer_total']),
+        'installments_total': _number(quote['installments_total']),
+        'notes': json.loads(quote['notes']) if quote['notes'] else [],
+        'lines': [
+            {
+                'line_number': row['line_number'],
+                'sku': row['sku'],
+                'name': row['name'],
+                'qty': row['qty'],
+                'unit_price': _number(row['unit_price']),
+                'line_total': _number(row['line_total']),
+                'attrs': json.loads(row['attrs']) if row['attrs'] else {},
+            }
+            for row in rows if row['line_number'] is not None
+        ],
+    }
+
+
+def get_quote_json(quote_id):
+    """
+    Return (body bytes, etag) for a quote's serialized JSON, or None if it
+    doesn't exist. Quotes are immutable, so serialized bodies are cached.
+    """
+    cached = _quote_cache.get(quote_id)
+    if cached is not None:
+        return cached
+
+    quote = fetch_quote(quote_id)
+    if quote is None:
+        return None
+    body = json.dumps(quote, separators=(',', ':')).encode('utf-8')
+    etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+    _quote_cache.put(quote_id, (body, etag))
+    return body, etag
+
+
+def quote_cache_stats():
+    return _quote_cache.stats()
@@ -0,0 +1,189 @@
+from db import get_connection
+
+# Base tables the API reads and writes, for standing up a fresh database
+# (e.g. the benchmark seeder); production tables already exist.
+BASE_TABLES = [
+    ('products', """
+        CREATE TABLE IF NOT EXISTS products (
+            sku VARCHAR(64) NOT NULL PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            brand VARCHAR(128) NULL,
+            category VARCHAR(128) NULL,
+            unit_price DECIMAL(12, 2) NOT NULL,
+            searchable_text TEXT NULL,
+            FULLTEXT KEY ft_products_text (searchable_text),
+            FULLTEXT KEY ft_products_name_text (name, searchable_text)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """),
+    ('embeddings', """
+        CREATE TABLE IF NOT EXISTS embeddings (
+            sku VARCHAR(64) NOT NULL PRIMARY KEY,
+            vec BLOB NULL,
+            dims INT NOT NULL,
+            model VARCHAR(128) NOT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """),
+    ('config_pricing', """
+        CREATE TABLE IF NOT EXISTS config_pricing (
+            id INT NOT NULL PRIMARY KEY,
+            transfer_discount DECIMAL(6, 4) NOT NULL,
+            installments_markup DECIMAL(6, 4) NOT NULL
+        ) ENGINE=InnoDB
+    """),
+    ('quotes', """
+        CREATE TABLE IF NOT EXISTS quotes (
+            quote_id VARCHAR(32) NOT NULL PRIMARY KEY,
+            customer_ref VARCHAR(128) NOT NULL,
+            valid_until DATETIME NOT NULL,
+            list_total DECIMAL(14, 2) NOT NULL,
+            transfer_total DECIMAL(14, 2) NOT NULL,
+            installments_total DECIMAL(14, 2) NOT NULL,
+            notes TEXT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """),
+    ('quote_lines', """
+        CREATE TABLE IF NOT EXISTS quote_lines (
+            quote_id VARCHAR(32) NOT NULL,
+            line_number INT NOT NULL,
+            sku VARCHAR(64) NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            qty INT NOT NULL,
+            unit_price DECIMAL(12, 2) NOT NULL,
+            line_total DECIMAL(14, 2) NOT NULL,
+            attrs JSON NULL,
+            PRIMARY KEY (quote_id, line_number)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """),
+]
+
+# Columns added on top of the base tables: (table, column, definition).
+# Applied idempotently by ensure_schema() (run once per deploy with
+# `python schema.py`); the API refuses to start while any is missing.
+COLUMNS = [
+    ('embeddings', 'content_hash', "CHAR(40) NULL"),
+    ('embeddings', 'updated_at', "TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)"),
+    ('quotes', 'pricing_version', "VARCHAR(16) NULL"),
+    ('products', 'updated_at', "TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)"),
+]
+
+# Tables added by migrations: (table, DDL)
+TABLES = [
+    # Counts products deleted (or whose SKU changed), so the product cache
+    # can notice them from one primary-key read (inserts and updates show
+    # up in MAX(updated_at))
+    ('catalog_version', """
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INT NOT NULL PRIMARY KEY,
+            deletes BIGINT NOT NULL DEFAULT 0
+        ) ENGINE=InnoDB
+    """),
+]
+
+# Triggers: (trigger name, DDL)
+TRIGGERS = [
+    ('trg_products_count_deletes', """
+        CREATE TRIGGER trg_products_count_deletes AFTER DELETE ON products FOR EACH ROW
+        UPDATE catalog_version SET deletes = deletes + 1 WHERE id = 1
+    """),
+    # A SKU change removes the old SKU just like a delete
+    ('trg_products_count_renames', """
+        CREATE TRIGGER trg_products_count_renames AFTER UPDATE ON products FOR EACH ROW
+        UPDATE catalog_version SET deletes = deletes + 1 WHERE id = 1 AND OLD.sku <> NEW.sku
+    """),
+]
+
+# Secondary indexes: (table, index name, columns)
+INDEXES = [
+    ('products', 'idx_products_updated_at', 'updated_at'),
+    ('embeddings', 'idx_embeddings_updated_at', 'updated_at'),
+]
+
+
+def missing_migrations():
+    """TABLES, COLUMNS and TRIGGERS entries that don't exist yet, by name"""
+    cnx = get_connection()
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("""
+            SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE()
+        """)
+        columns = {(table, column) for table, column in cursor.fetchall()}
+        cursor.execute("SELECT TRIGGER_NAME FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = DATABASE()")
+        triggers = {name for (name,) in cursor.fetchall()}
+    finally:
+        cursor.close()
+        cnx.close()
+    tables = {table for table, _ in columns}
+    return (
+        [f"table {table}" for table, _ in TABLES if table not in tables]
+        + [f"{table}.{column}" for table, column, _ in COLUMNS if (table, column) not in columns]
+        + [f"trigger {name}" for name, _ in TRIGGERS if name not in triggers]
+    )
+
+
+def require_schema():
+    """Raise RuntimeError if the migrations haven't been applied"""
+    missing = missing_migrations()
+    if missing:
+        raise RuntimeError(
+            f"Database schema is missing {', '.join(missing)}; run `python schema.py` to migrate"
+        )
+
+
+def ensure_schema():
+    """Add any missing TABLES, COLUMNS, INDEXES and TRIGGERS"""
+    cnx = get_connection()
+    cursor = cnx.cursor()
+    try:
+        for table, ddl in TABLES:
+            cursor.execute(ddl)
+        cursor.execute("INSERT IGNORE INTO catalog_version (id, deletes) VALUES (1, 0)")
+        for table, column, definition in COLUMNS:
+            cursor.execute("""
+                SELECT COUNT(*) FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+            """, (table, column))
+            if cursor.fetchone()[0] == 0:
+                print(f"Adding column {table}.{column}")
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        for table, index, columns in INDEXES:
+            cursor.execute("""
+                SELECT COUNT(*) FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+            """, (table, index))
+            if cursor.fetchone()[0] == 0:
+                print(f"Adding index {table}.{index}")
+                cursor.execute(f"ALTER TABLE {table} ADD INDEX {index} ({columns})")
+        for name, ddl in TRIGGERS:
+            cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = DATABASE() AND TRIGGER_NAME = %s",
+                (name,)
+            )
+            if cursor.fetchone()[0] == 0:
+                print(f"Adding trigger {name}")
+                cursor.execute(ddl)
+        cnx.commit()
+    finally:
+        cursor.close()
+        cnx.close()
+
+
+def create_base_tables():
+    """Create any missing BASE_TABLES, then apply the migrations"""
+    cnx = get_connection()
+    cursor = cnx.cursor()
+    try:
+        for table, ddl in BASE_TABLES:
+            cursor.execute(ddl)
+        cnx.commit()
+    finally:
+        cursor.close()
+        cnx.close()
+    ensure_schema()
+
+
+if __name__ == "__main__":
+    ensure_schema()
+    print("Schema is up to date")
@@ -0,0 +1,130 @@
+"""
+Brand / category / price filters for search.
+
+The keyword leg applies them as SQL conditions (or a mask over the lexical
+index); the vector leg gets a boolean mask aligned with the embedding
+matrix rows, so the scan only scores products that can be returned.
+
+Product attributes come from the lexical index when it's built, else from
+a copy loaded at startup and reloaded in the background after catalog
+changes; requests never read the products table for them.
+"""
+import time
+from collections import namedtuple
+import numpy as np
+
+import metrics
+import product_cache
+from db import get_connection
+from lexical_index import AttributeMasks, get_lexical_index
+
+SearchFilters = namedtuple('SearchFilters', 'brand category min_price max_price')
+
+_row_masks = None        # (key, AttributeMasks) aligned with the current vector snapshot
+_attributes = None       # (version, skus, brands, categories, prices), used without a lexical index
+_started = False
+
+
+def make_filters(brand=None, category=None, min_price=None, max_price=None):
+    """SearchFilters for the given constraints, or None if there are none"""
+    brand = brand.strip() if brand else None
+    category = category.strip() if category else None
+    if not brand and not category and min_price is None and max_price is None:
+        return None
+    return SearchFilters(brand or None, category or None, min_price, max_price)
+
+
+def sql_conditions(filters):
+    """(conditions to AND into a products WHERE clause, their parameters)"""
+    conditions = []
+    params = []
+    if filters is None:
+        return conditions, params
+    if filters.brand:
+        conditions.append("brand = %s")
+        params.append(filters.brand)
+    if filters.category:
+        conditions.append("category = %s")
+        params.append(filters.category)
+    if filters.min_price is not None:
+        conditions.append("unit_price >= %s")
+        params.append(filters.min_price)
+    if filters.max_price is not None:
+        conditions.append("unit_price <= %s")
+        params.append(filters.max_price)
+    return conditions, params
+
+
+def load_attributes():
+    """Reload the filterable product attributes and swap them in"""
+    global _attributes
+    start = time.perf_counter()
+    cnx = get_connection()
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT sku, brand, category, unit_price FROM products")
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        cnx.close()
+    _attributes = (
+        (_attributes[0] + 1) if _attributes is not None else 1,
+        [row[0] for row in rows],
+        [row[1] for row in rows],
+        [row[2] for row in rows],
+        [float(row[3]) for row in rows],
+    )
+    metrics.observe('filter_attributes_load', time.perf_counter() - start)
+
+
+def start():
+    """Load the attributes now and reload them in the background after catalog changes"""
+    global _started
+    if _started:
+        return
+    _started = True
+    changed = product_cache.rebuild_on_change('Filter attributes', load_attributes)
+    try:
+        load_attributes()
+    except Exception as e:
+        print(f"Filter attributes load failed, retrying in the background: {e}")
+        changed.set()
+
+
+def _catalog():
+    """(cache key, skus, brands, categories, prices) of the current catalog"""
+    index = get_lexical_index()
+    if index is not None:
+        return ('lexical', index.version), index.skus, index.brands, index.categories, index.prices
+    attributes = _attributes
+    if attributes is None:
+        raise RuntimeError("Product attributes for search filters aren't loaded yet")
+    return ('products', attributes[0]), *attributes[1:]
+
+
+def row_mask(snapshot, filters):
+    """
+    Boolean mask over a VectorSnapshot's matrix rows selecting the products
+    that pass `filters`. Attributes are aligned with the snapshot once per
+    snapshot and catalog version. Raises RuntimeError before any attributes
+    have loaded, so the vector leg degrades instead of ignoring the filters.
+    """
+    global _row_masks
+    catalog_key, skus, brands, categories, prices = _catalog()
+    key = (id(snapshot), snapshot.version, catalog_key)
+    cached = _row_masks
+    if cached is None or cached[0] != key:
+        position = {sku: i for i, sku in enumerate(skus)}
+        rows = np.fromiter((position.get(sku, -1) for sku in snapshot.skus), dtype=np.int64,
+                           count=len(snapshot.skus))
+        found = rows >= 0
+        aligned_prices = np.full(len(rows), np.nan)
+        aligned_prices[found] = np.asarray(prices, dtype=np.float64)[rows[found]]
+        # Rows without a product never match a brand, category or price filter
+        cached = (key, AttributeMasks(
+            [brands[i] if i >= 0 else None for i in rows],
+            [categories[i] if i >= 0 else None for i in rows],
+            aligned_prices,
+        ))
+        _row_masks = cached
+    return cached[1].mask(filters)
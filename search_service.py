@@ -1,70 +1,190 @@
-import mysql.connector
-import numpy as np
-from sentence_transformers import SentenceTransformer
-
-def get_db_connection():
-    return mysql.connector.connect(
-        host='localhost',
-        user='root',
-        password='mahin1tanim2@',  # <-- Change to your actual password
-        database='casa_rom_sales'
-    )
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import lexical_index
+import metrics
+import product_cache
+from cache import LRUCache
+from db import DB_POOL_TIMEOUT, get_connection as get_db_connection
+from model_registry import encode_queries, encode_query
+from search_filters import make_filters, sql_conditions
+from vector_store import get_vector_store
+
+# Seconds a search waits for its retrieval legs (including time queued for
+# a thread) before falling back to whatever finished
+SEARCH_LEG_TIMEOUT = float(os.environ.get('SEARCH_LEG_TIMEOUT', '2.0'))
+# The keyword leg's MySQL fallback waits at most this long for a pool
+# connection and a statement, so a leg abandoned at the deadline frees its
+# executor thread soon after
+SEARCH_LEG_DB_TIMEOUT = min(DB_POOL_TIMEOUT, SEARCH_LEG_TIMEOUT)
+SEARCH_LEG_SQL_HINT = f"/*+ MAX_EXECUTION_TIME({int(SEARCH_LEG_TIMEOUT * 1000)}) */"
+
+# Cached search responses; see cached_search
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', '10000'))
+
+_result_cache = LRUCache(SEARCH_CACHE_SIZE)
+_result_cache_versions = None
+# Per-thread flag set by run_search_legs when a leg failed or timed out
+_search_state = threading.local()
+
+# Runs the legs that don't run inline: up to two per request thread (when
+# the keyword leg falls back to MySQL), and anyio's default threadpool has 40
+_leg_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SEARCH_LEG_WORKERS', '80')),
+    thread_name_prefix='search-leg'
+)
+# Seconds a /search/batch request waits for its legs, including queueing
+SEARCH_BATCH_TIMEOUT = float(os.environ.get('SEARCH_BATCH_TIMEOUT', '10'))
+# Batch searches get their own threads, so a large batch can't hold the
+# threads /search needs
+_batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SEARCH_BATCH_WORKERS', '4')),
+    thread_name_prefix='search-batch'
+)
+
+def submit_leg(executor, leg):
+    """Run `leg` on `executor` in a copy of this context, so its stage timings count towards the request"""
+    return executor.submit(contextvars.copy_context().run, leg)
+
+def run_leg(name, leg):
+    """Run a leg inline; returns (results, error), with [] results if it raised"""
+    try:
+        return leg(), None
+    except Exception as e:
+        print(f"Search {name} leg failed: {e}")
+        _search_state.degraded = True
+        return [], e
 
-def fulltext_boolean_search(query, limit=20):
+def wait_leg(name, future, deadline):
     """
-    Perform full-text search using MySQL FULLTEXT index with BOOLEAN MODE
+    Wait for a submitted leg until `deadline` (a time.monotonic() value);
+    returns (results, error). A leg that misses the deadline is cancelled if
+    it hasn't started and contributes [] with a FutureTimeout error.
+    """
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic())), None
+    except FutureTimeout as e:
+        future.cancel()
+        _search_state.degraded = True
+        print(f"Search {name} leg missed its deadline; using other leg only")
+        return [], e
+    except Exception as e:
+        print(f"Search {name} leg failed: {e}")
+        _search_state.degraded = True
+        return [], e
+
+def run_search_legs(keyword_leg, vector_leg, timeout=SEARCH_LEG_TIMEOUT):
+    """
+    Run the keyword (BM25) and vector legs concurrently and wait at most
+    `timeout` seconds from now for them, including any time spent queued
+    for an executor thread.
+
+    The vector leg runs on the leg executor. The keyword leg runs inline
+    when the in-memory lexical index serves it (it takes milliseconds), and
+    on the executor when it has to go to MySQL. A leg that raises or misses
+    the deadline contributes no results, so search degrades to single-leg
+    results. If both legs raise (rather than time out), the keyword leg's
+    error is re-raised.
+
+    Returns (keyword_results, vector_results)
+    """
+    deadline = time.monotonic() + timeout
+    inline = lexical_index.get_lexical_index() is not None
+    keyword_future = None if inline else submit_leg(_leg_executor, keyword_leg)
+    vector_future = submit_leg(_leg_executor, vector_leg)
+    if inline:
+        keyword_results, keyword_error = run_leg('keyword', keyword_leg)
+    else:
+        keyword_results, keyword_error = wait_leg('keyword', keyword_future, deadline)
+    vector_results, vector_error = wait_leg('vector', vector_future, deadline)
+    failed = [e for e in (keyword_error, vector_error) if e is not None and not isinstance(e, FutureTimeout)]
+    if len(failed) == 2:
+        raise keyword_error
+    return keyword_results, vector_results
+
+def normalize_query(query):
+    """Case- and whitespace-insensitive form of a query (both legs ignore case)"""
+    return ' '.join(query.lower().split())
+
+def cached_search(kind, query, limit, alpha, compute, filters=None):
+    """
+    Serve a search from the result cache, or run `compute()` and cache it.
+
+    Keys are (kind, normalized query, limit, alpha, filters). The cache is dropped
+    whenever the vector store or lexical index reloads or the product cache
+    sees a catalog change, so cached results never outlive their data.
+    Results degraded by a failed or timed-out leg are not cached.
+    Cached results are shared: callers must not mutate them.
+    """
+    global _result_cache_versions
+    versions = _data_versions()
+    if versions != _result_cache_versions:
+        _result_cache.clear()
+        _result_cache_versions = versions
+
+    key = (kind, normalize_query(query), limit, round(float(alpha), 4), filters)
+    result = _result_cache.get(key)
+    if result is None:
+        _search_state.degraded = False
+        result = compute()
+        # Don't cache single-leg fallbacks or results computed across a data change
+        if not _search_state.degraded and versions == _data_versions():
+            _result_cache.put(key, result)
+    return result
+
+def _data_versions():
+    return get_vector_store().version, product_cache.version, lexical_index.version()
+
+def search_cache_stats():
+    return _result_cache.stats()
+
+@metrics.timed('keyword')
+def fulltext_boolean_search(query, limit=20, filters=None):
+    """
+    Perform full-text search, from the in-memory lexical index when it's
+    built, else using MySQL FULLTEXT index with BOOLEAN MODE
     Returns products with BM25 relevance scores
     """
-    cnx = get_db_connection()
+    results = lexical_index.search(query, limit, filters)
+    if results is not None:
+        return results
+
+    cnx = get_db_connection(SEARCH_LEG_DB_TIMEOUT)
     cursor = cnx.cursor(dictionary=True)
     
     try:
-        # Sanitize query to prevent SQL injection
-        safe_query = query.replace("'", "''").replace("\\", "\\\\")
-        
+        # Filters are pushed into the WHERE clause; everything is a bound parameter
+        against = f"+{query}*"
+        conditions, params = sql_conditions(filters)
+        where = ''.join(f" AND {condition}" for condition in conditions)
         sql = f"""
-            SELECT sku, name, brand, unit_price,
-                   MATCH(name, searchable_text) AGAINST ('+{safe_query}*' IN BOOLEAN MODE) AS bm25_score
+            SELECT {SEARCH_LEG_SQL_HINT} sku, name, brand, unit_price,
+                   MATCH(name, searchable_text) AGAINST (%s IN BOOLEAN MODE) AS bm25_score
             FROM products
-            WHERE MATCH(name, searchable_text) AGAINST ('+{safe_query}*' IN BOOLEAN MODE)
+            WHERE MATCH(name, searchable_text) AGAINST (%s IN BOOLEAN MODE){where}
             ORDER BY bm25_score DESC
-            LIMIT {limit}
+            LIMIT %s
         """
-        cursor.execute(sql)
+        cursor.execute(sql, [against, against] + params + [int(limit)])
         results = cursor.fetchall()
         return results
     finally:
         cursor.close()
         cnx.close()
 
-def vector_similarity_search(query, model, limit=20):
+@metrics.timed('vector')
+def vector_similarity_search(query, limit=20, filters=None):
     """
     Perform vector similarity search using embeddings
     Returns products with cosine similarity scores
     """
-    query_vec = model.encode(query, convert_to_numpy=True)
-    cnx = get_db_connection()
-    cursor = cnx.cursor()
-    
-    try:
-        cursor.execute("SELECT sku, vec, dims FROM embeddings")
-        sims = []
-        
-        for sku, vec_blob, dims in cursor.fetchall():
-            if vec_blob is None:
-                continue
-            vec = np.frombuffer(vec_blob, dtype=np.float32)
-            
-            # Calculate cosine similarity
-            sim = np.dot(query_vec, vec) / (np.linalg.norm(query_vec) * np.linalg.norm(vec))
-            sims.append({'sku': sku, 'vector_score': float(sim)})
-        
-        # Sort by similarity
-        sims.sort(key=lambda x: x['vector_score'], reverse=True)
-        return sims[:limit]
-    finally:
-        cursor.close()
-        cnx.close()
+    query_vec = encode_query(query)
+    store = get_vector_store()
+    store.ensure_loaded(get_db_connection)
+    return [{'sku': sku, 'vector_score': score} for sku, score in store.search(query_vec, limit, filters)]
 
 def normalize_scores(score_dict):
     """
@@ -84,28 +204,19 @@ def normalize_scores(score_dict):
 
 def get_product_details(skus):
     """
-    Fetch full product details for a list of SKUs
+    Fetch product details for a list of SKUs in one batched lookup,
+    served from the in-memory product cache where possible
     """
     if not skus:
-        return []
-    
-    cnx = get_db_connection()
-    cursor = cnx.cursor(dictionary=True)
+        return {}
     
-    try:
-        placeholders = ','.join(['%s'] * len(skus))
-        sql = f"SELECT sku, name, brand, unit_price FROM products WHERE sku IN ({placeholders})"
-        cursor.execute(sql, skus)
-        products = cursor.fetchall()
-        
-        # Create a dict for easy lookup
-        product_dict = {p['sku']: p for p in products}
-        return product_dict
-    finally:
-        cursor.close()
-        cnx.close()
+    products = product_cache.get_products(skus)
+    return {
+        sku: {'sku': p.sku, 'name': p.name, 'brand': p.brand, 'unit_price': p.unit_price}
+        for sku, p in products.items()
+    }
 
-def hybrid_search(query, alpha=0.6, limit=20):
+def hybrid_search(query, alpha=0.6, limit=20, brand=None, category=None, min_price=None, max_price=None):
     """
     Perform hybrid search combining BM25 and vector similarity
     
@@ -113,17 +224,39 @@ def hybrid_search(query, alpha=0.6, limit=20):
         query: Search query string
         alpha: Weight for vector score (0-1). BM25 weight = 1-alpha
         limit: Maximum number of results to return
+        brand, category: Only return products of this brand / category
+        min_price, max_price: Only return products in this unit price range
     
     Returns:
-        List of products with hybrid scores
+        List of products with hybrid scores (served from the result cache
+        for repeated queries)
+    """
+    filters = make_filters(brand, category, min_price, max_price)
+    return cached_search('service', query, limit, alpha,
+                         lambda: _hybrid_search(query, alpha, limit, filters), filters)
+
+def _hybrid_search(query, alpha, limit, filters=None):
+    # Get results from both search methods concurrently; filters apply inside each leg
+    bm25_results, vector_results = run_search_legs(
+        lambda: fulltext_boolean_search(query, limit * 2, filters),
+        lambda: vector_similarity_search(query, limit * 2, filters),
+    )
+    top_results = fuse_results(bm25_results, vector_results, alpha, limit)
+    if not top_results:
+        return []
+
+    # Get full product details
+    top_skus = [r['sku'] for r in top_results]
+    with metrics.stage('hydrate'):
+        product_details = get_product_details(top_skus)
+    return merge_details(top_results, product_details)
+
+def fuse_results(bm25_results, vector_results, alpha, limit):
+    """
+    Min-max normalize each leg's scores and rank SKUs by
+    alpha * vector + (1 - alpha) * bm25; returns the top `limit` as dicts
+    with sku and the three scores
     """
-    # Load embedding model
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    
-    # Get results from both search methods
-    bm25_results = fulltext_boolean_search(query, limit * 2)
-    vector_results = vector_similarity_search(query, model, limit * 2)
-    
     # Extract scores
     bm25_scores = {r['sku']: r['bm25_score'] for r in bm25_results}
     vector_scores = {r['sku']: r['vector_score'] for r in vector_results}
@@ -139,33 +272,31 @@ def hybrid_search(query, alpha=0.6, limit=20):
     vector_norm = normalize_scores(vector_scores) if vector_scores else {}
     
     # Combine scores with weighted fusion
-    fused = []
-    for sku in all_skus:
-        bm25 = bm25_norm.get(sku, 0)
-        vec = vector_norm.get(sku, 0)
-        hybrid_score = alpha * vec + (1 - alpha) * bm25
-        
-        fused.append({
-            'sku': sku,
-            'hybrid_score': hybrid_score,
-            'bm25_score': bm25,
-            'vector_score': vec
-        })
-    
-    # Sort by hybrid score
-    fused.sort(key=lambda x: x['hybrid_score'], reverse=True)
-    top_results = fused[:limit]
-    
-    # Get full product details
-    top_skus = [r['sku'] for r in top_results]
-    product_details = get_product_details(top_skus)
-    
-    # Merge scores with product details
+    with metrics.stage('fuse'):
+        fused = []
+        for sku in all_skus:
+            bm25 = bm25_norm.get(sku, 0)
+            vec = vector_norm.get(sku, 0)
+            hybrid_score = alpha * vec + (1 - alpha) * bm25
+
+            fused.append({
+                'sku': sku,
+                'hybrid_score': hybrid_score,
+                'bm25_score': bm25,
+                'vector_score': vec
+            })
+
+        # Sort by hybrid score
+        fused.sort(key=lambda x: x['hybrid_score'], reverse=True)
+        return fused[:limit]
+
+def merge_details(top_results, product_details):
+    """Product details with the rounded scores of fused results, in rank order"""
     final_results = []
     for result in top_results:
         sku = result['sku']
         if sku in product_details:
-            product = product_details[sku]
+            product = dict(product_details[sku])
             product.update({
                 'hybrid_score': round(result['hybrid_score'], 4),
                 'bm25_score': round(result['bm25_score'], 4),
@@ -174,3 +305,52 @@ def hybrid_search(query, alpha=0.6, limit=20):
             final_results.append(product)
     
     return final_results
+
+def hybrid_search_many(queries, alpha=0.6, limit=20, brand=None, category=None, min_price=None, max_price=None):
+    """
+    hybrid_search() for a batch of queries. The queries are encoded
+    together and scored against the embedding matrix with matrix-matrix
+    products, and the union of fused SKUs is hydrated in one lookup.
+
+    The vector leg runs on the batch executor. Each query's keyword lookup
+    runs inline when the lexical index serves it, else as its own job on the
+    batch executor. Everything is bounded by SEARCH_BATCH_TIMEOUT from the
+    start of the call.
+
+    Returns (one result list per query, one degraded flag per query); a query
+    is degraded if its keyword lookup or the vector leg failed or missed the
+    deadline.
+    """
+    if not queries:
+        return [], []
+    filters = make_filters(brand, category, min_price, max_price)
+    deadline = time.monotonic() + SEARCH_BATCH_TIMEOUT
+
+    def vector_leg():
+        with metrics.stage('vector'):
+            store = get_vector_store()
+            store.ensure_loaded(get_db_connection)
+            return store.search_many(encode_queries(queries), limit * 2, filters)
+
+    def keyword_leg(query):
+        return lambda: fulltext_boolean_search(query, limit * 2, filters)
+
+    vector_future = submit_leg(_batch_executor, vector_leg)
+    if lexical_index.get_lexical_index() is not None:
+        keyword = [run_leg('keyword', keyword_leg(query)) for query in queries]
+    else:
+        futures = [submit_leg(_batch_executor, keyword_leg(query)) for query in queries]
+        keyword = [wait_leg('keyword', future, deadline) for future in futures]
+    vector_batches, vector_error = wait_leg('vector', vector_future, deadline)
+    if vector_error is not None:
+        vector_batches = [[] for _ in queries]
+
+    fused = [
+        fuse_results(bm25_results, [{'sku': sku, 'vector_score': score} for sku, score in vector_results],
+                     alpha, limit)
+        for (bm25_results, _), vector_results in zip(keyword, vector_batches)
+    ]
+    degraded = [keyword_error is not None or vector_error is not None for _, keyword_error in keyword]
+    with metrics.stage('hydrate'):
+        product_details = get_product_details(list({r['sku'] for results in fused for r in results}))
+    return [merge_details(top_results, product_details) for top_results in fused], degraded
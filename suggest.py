@@ -0,0 +1,159 @@
+"""
+Typeahead suggestions for the storefront search box.
+
+Product names (from each word on, so 'marmol' finds 'Porcelanato mármol
+gris'), brands and SKUs are normalized like the lexical index and kept in
+one sorted array; a prefix is a bisect to the range of keys it starts, and
+the range's most popular entries win. Popularity is the quantity quoted per
+SKU (summed per brand). Top entries for one- and two-character prefixes are
+precomputed, since their ranges cover much of the catalog.
+
+Requests only read the in-memory structure. It's rebuilt in the background
+after catalog changes and every SUGGEST_REFRESH_INTERVAL seconds, to pick up
+new popularity.
+"""
+import bisect
+import os
+import time
+from collections import defaultdict
+import numpy as np
+
+import metrics
+import product_cache
+from ann_index import top_k
+from db import get_connection
+from lexical_index import load_catalog, normalize
+
+# Seconds between rebuilds that refresh popularity weights
+SUGGEST_REFRESH_INTERVAL = float(os.environ.get('SUGGEST_REFRESH_INTERVAL', '3600'))
+# Most suggestions a request may ask for
+SUGGEST_MAX_LIMIT = 20
+# Leading name words a product is also suggested from
+_NAME_WORDS = 6
+_PRECOMPUTED_PREFIX = 2
+
+
+class SuggestIndex:
+    """Sorted prefix keys over one load of the catalog"""
+
+    def __init__(self, rows, popularity):
+        entries = []            # (type, text, sku)
+        weights = []
+        keyed = []              # (key, entry id)
+
+        brand_weight = defaultdict(float)
+        for row in rows:
+            weight = float(popularity.get(row['sku'], 0))
+            entry = len(entries)
+            entries.append(('product', row['name'], row['sku']))
+            weights.append(weight)
+            words = normalize(row['name']).split()
+            for i in range(min(len(words), _NAME_WORDS)):
+                keyed.append((' '.join(words[i:]), entry))
+
+            entries.append(('sku', row['sku'], row['sku']))
+            weights.append(weight)
+            keyed.append((''.join(normalize(row['sku']).split()), entry + 1))
+            if row['brand']:
+                # Every product counts, so brands nobody quoted still rank by size
+                brand_weight[row['brand']] += weight + 1
+
+        for brand, weight in brand_weight.items():
+            keyed.append((' '.join(normalize(brand).split()), len(entries)))
+            entries.append(('brand', brand, None))
+            weights.append(weight)
+
+        keyed.sort()
+        self.keys = [key for key, _ in keyed]
+        self.entry_ids = np.array([entry for _, entry in keyed], dtype=np.int32)
+        self.entries = entries
+        self.weights = np.array(weights, dtype=np.float64)
+        self._key_weights = self.weights[self.entry_ids]
+
+        self._top = {}
+        prefixes = {key[:n] for key in self.keys for n in range(1, _PRECOMPUTED_PREFIX + 1) if len(key) >= n}
+        for prefix in prefixes:
+            self._top[prefix] = self._scan(prefix, SUGGEST_MAX_LIMIT)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _scan(self, prefix, limit):
+        """Entry ids of the `limit` most popular distinct entries with a key starting with `prefix`"""
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + '\uffff', lo)
+        if lo == hi:
+            return []
+        # An entry can own several keys in the range, so over-fetch before deduping
+        ids = self.entry_ids[lo:hi]
+        best = ids[top_k(self._key_weights[lo:hi], limit * _NAME_WORDS)]
+        return list(dict.fromkeys(best.tolist()))[:limit]
+
+    def suggest(self, prefix, limit=10):
+        """Up to `limit` suggestions for a typed prefix, most popular first"""
+        prefix = ' '.join(normalize(prefix).split())
+        limit = max(0, min(limit, SUGGEST_MAX_LIMIT))
+        if not prefix or not limit:
+            return []
+        ids = self._top.get(prefix)
+        if ids is None:
+            ids = self._scan(prefix, limit)
+        return [
+            {'type': kind, 'text': text, 'sku': sku}
+            for kind, text, sku in (self.entries[i] for i in ids[:limit])
+        ]
+
+
+_index = None
+_started = False
+
+
+def load_popularity():
+    """{sku: total quantity quoted}"""
+    cnx = get_connection()
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT sku, SUM(qty) FROM quote_lines GROUP BY sku")
+        return {sku: float(total or 0) for sku, total in cursor.fetchall()}
+    finally:
+        cursor.close()
+        cnx.close()
+
+
+def rebuild():
+    global _index
+    start = time.perf_counter()
+    index = SuggestIndex(load_catalog(), load_popularity())
+    _index = index
+    metrics.observe('suggest_build', time.perf_counter() - start)
+    print(f"Suggest index built with {len(index.keys)} keys in {time.perf_counter() - start:.2f}s")
+    return index
+
+
+def start():
+    """Build the suggestions now and keep them fresh in the background"""
+    global _started
+    if _started:
+        return
+    _started = True
+    changed = product_cache.rebuild_on_change('Suggest index', rebuild, SUGGEST_REFRESH_INTERVAL)
+    try:
+        rebuild()
+    except Exception as e:
+        print(f"Suggest index build failed, retrying in the background: {e}")
+        changed.set()
+
+
+def suggest(prefix, limit=10):
+    """Suggestions for `prefix`; empty until the index has been built"""
+    index = _index
+    if index is None:
+        return []
+    return index.suggest(prefix, limit)
+
+
+def stats():
+    index = _index
+    if index is None:
+        return {'entries': 0, 'keys': 0}
+    return {'entries': len(index), 'keys': len(index.keys)}
@@ -0,0 +1,417 @@
+import os
+import threading
+import time
+import numpy as np
+
+import embedding_snapshot
+import metrics
+import search_filters
+from ann_index import ExactIndex, build_index
+from quantization import VECTOR_RESCORE_FACTOR, VECTOR_STORAGE, QuantizedMatrix, quantize
+
+
+# Seconds between background delta refreshes (0 disables the refresher)
+VECTOR_REFRESH_INTERVAL = float(os.environ.get('VECTOR_REFRESH_INTERVAL', '60'))
+
+
+class VectorSnapshot:
+    """
+    An immutable, fully built generation of the embedding matrix and its
+    index. Searches grab the current snapshot once, so a refresh can build the
+    next one off to the side and swap it in without blocking them.
+    """
+
+    def __init__(self, skus, matrix, index, marker, version, full=None, source='database'):
+        self.skus = skus
+        self.matrix = matrix      # float32 ndarray, or a QuantizedMatrix
+        self.full = full          # SnapshotRows for re-scoring quantized scans
+        self.source = source
+        self.index = index
+        self.marker = marker      # (row count, MAX(updated_at)) the snapshot reflects
+        self.version = version
+        self.loaded_at = time.time()
+        self.rows = {sku: i for i, sku in enumerate(skus)}
+
+
+
+class SnapshotRows:
+    """
+    Full-precision rows for re-scoring quantized scans: the memory-mapped
+    snapshot matrix, plus the rows deltas changed or appended since it was
+    written, kept in memory. Indexing returns float32 rows.
+    """
+
+    def __init__(self, base, changed=None):
+        self.base = base
+        self.changed = changed or {}    # row id -> float32 vector
+
+    def with_rows(self, replace_ids, replace_rows, appended_rows, start):
+        """Rows with `replace_ids` overwritten and `appended_rows` added from row `start`"""
+        changed = dict(self.changed)
+        changed.update(zip(replace_ids, replace_rows))
+        changed.update((start + i, row) for i, row in enumerate(appended_rows))
+        return SnapshotRows(self.base, changed)
+
+    def __getitem__(self, ids):
+        ids = np.asarray(ids)
+        rows = np.zeros((len(ids), self.base.shape[1]), dtype=np.float32)
+        in_base = ids < len(self.base)
+        rows[in_base] = self.base[ids[in_base]]
+        if self.changed:
+            for n, i in enumerate(ids.tolist()):
+                row = self.changed.get(i)
+                if row is not None:
+                    rows[n] = row
+        return rows
+
+
+class VectorStore:
+    """
+    Process-wide embedding matrix for the vector leg of search.
+
+    Rows are loaded once into a single contiguous float32 matrix with
+    L2-normalized rows, so cosine similarity against every SKU
+    is one matrix-vector product. The configured ANN index (see ann_index)
+    decides which rows a query actually scans.
+
+    The matrix is memory-mapped from the on-disk snapshot (see
+    embedding_snapshot) when it matches the embeddings table, so workers share
+    one page-cache copy; otherwise it's read from MySQL.
+
+    With VECTOR_STORAGE set to float16 or int8 the resident matrix is
+    quantized; the coarse scan keeps VECTOR_RESCORE_FACTOR candidates per
+    result, which are re-scored against their full-precision vectors in the
+    memory-mapped snapshot (shared by all workers). Without a fresh snapshot
+    there's nothing to re-score from, so the matrix stays float32 until one
+    appears; searches never go back to the database.
+
+    refresh() picks up new and changed embeddings by their updated_at and
+    atomically swaps in a new snapshot.
+    """
+
+    def __init__(self):
+        matrix = np.empty((0, 0), dtype=np.float32)
+        self._snapshot = VectorSnapshot(np.empty(0, dtype=object), matrix, ExactIndex().build(matrix), None, 0)
+        self.loaded = False
+        self._bad_snapshot = None    # path of a fresh snapshot that failed to load
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def skus(self):
+        return self._snapshot.skus
+
+    @property
+    def matrix(self):
+        return self._snapshot.matrix
+
+    @property
+    def index(self):
+        return self._snapshot.index
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def load(self, connect):
+        """Load all embeddings using the given connection factory"""
+        with self._lock:
+            self._load(connect)
+
+    def _load(self, connect):
+        start = time.perf_counter()
+        cnx = connect()
+        cursor = cnx.cursor()
+        try:
+            # Read the marker first: rows changed during the load are newer
+            # than it and get picked up by the next refresh
+            marker = read_marker(cursor)
+            header = embedding_snapshot.read_header()
+            mapped = None
+            if embedding_snapshot.is_fresh(header, marker):
+                # The version can be pruned or truncated after its header was read
+                try:
+                    mapped = embedding_snapshot.load_snapshot(header)
+                except Exception as e:
+                    print(f"Embedding snapshot {header['path']} failed to load, reading MySQL instead: {e}")
+                    self._bad_snapshot = header['path']
+            if mapped is None:
+                cursor.execute("SELECT sku, vec FROM embeddings WHERE vec IS NOT NULL")
+                rows = cursor.fetchall()
+        finally:
+            cursor.close()
+            cnx.close()
+
+        if mapped is not None:
+            skus, matrix = mapped
+            source = 'snapshot'
+        else:
+            skus, matrix = build_matrix(rows)
+            source = 'database'
+
+        # Indexes are trained on full precision, then scan the compact copy
+        index = build_index(matrix, skus)
+        if source == 'snapshot':
+            compact = quantize(matrix)
+        else:
+            compact = matrix
+            if VECTOR_STORAGE != 'float32':
+                print(f"No fresh embedding snapshot to re-score from; keeping float32 storage "
+                      f"instead of {VECTOR_STORAGE} until one is exported")
+        index.matrix = compact
+        full = SnapshotRows(matrix) if compact is not matrix else None
+        self._swap(skus, compact, index, marker, full, source)
+        metrics.observe('vector_load', time.perf_counter() - start)
+        print(f"Vector store loaded {len(skus)} embeddings from {source} ({index.kind} index, "
+              f"{getattr(compact, 'storage', 'float32')} storage, {compact.nbytes / 2**20:.1f} MiB)")
+
+    def _swap(self, skus, matrix, index, marker, full=None, source='database'):
+        self._snapshot = VectorSnapshot(skus, matrix, index, marker, self._snapshot.version + 1, full, source)
+        self.loaded = True
+
+    def ensure_loaded(self, connect):
+        if self.loaded:
+            return
+        with self._lock:
+            if not self.loaded:
+                self._load(connect)
+
+    def refresh(self, connect):
+        """
+        Apply embeddings added or changed since the current snapshot. Falls
+        back to a full reload when rows were deleted or dimensions changed,
+        and switches to the on-disk snapshot as soon as one matches, even if
+        the embeddings haven't changed since (e.g. a delta was applied while
+        it was being exported). Returns the number of rows applied (0 if
+        nothing changed).
+        """
+        with self._lock:
+            if not self.loaded:
+                self._load(connect)
+                return len(self.skus)
+
+            current = self._snapshot
+            cnx = connect()
+            cursor = cnx.cursor()
+            try:
+                marker = read_marker(cursor)
+                # A fresh on-disk snapshot is cheaper to map than applying a
+                # delta, and shares its pages with the other workers
+                # (one that already failed to load isn't retried on every refresh)
+                header = embedding_snapshot.read_header()
+                fresh_snapshot = (current.source != 'snapshot'
+                                  and embedding_snapshot.is_fresh(header, marker)
+                                  and header['path'] != self._bad_snapshot)
+                if marker == current.marker and not fresh_snapshot:
+                    return 0
+                if fresh_snapshot or current.marker is None or current.marker[1] is None:
+                    delta = None
+                else:
+                    cursor.execute(
+                        "SELECT sku, vec FROM embeddings WHERE vec IS NOT NULL AND updated_at >= %s",
+                        (current.marker[1],)
+                    )
+                    delta = cursor.fetchall()
+            finally:
+                cursor.close()
+                cnx.close()
+
+            if delta is not None:
+                new_skus, new_rows = build_matrix(delta)
+                if len(new_skus) == 0 or new_rows.shape[1] == current.matrix.shape[1]:
+                    skus, matrix, full = _apply_delta(current, new_skus, new_rows)
+                    # Rows were deleted (or nulled) if the counts disagree
+                    if len(skus) == marker[0]:
+                        index = current.index.rebuild(matrix)
+                        self._swap(skus, matrix, index, marker, full, source='delta')
+                        print(f"Vector store applied {len(new_skus)} changed embeddings "
+                              f"(version {self.version}, {len(skus)} rows)")
+                        return len(new_skus)
+
+            self._load(connect)
+            return len(self.skus)
+
+    def search(self, query_vec, limit=20, filters=None):
+        """
+        Return the top `limit` (sku, cosine similarity) pairs for a query vector,
+        best first. With `filters` (a SearchFilters) only matching products are
+        scanned.
+        """
+        snapshot = self._snapshot
+        if limit <= 0 or len(snapshot.skus) == 0:
+            return []
+        mask = None
+        if filters is not None:
+            mask = search_filters.row_mask(snapshot, filters)
+            if not mask.any():
+                return []
+
+        query = np.asarray(query_vec, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        query = query / norm
+        if isinstance(snapshot.matrix, QuantizedMatrix):
+            with metrics.stage('vector_scan'):
+                ids, _ = snapshot.index.search(query, limit * VECTOR_RESCORE_FACTOR, mask=mask)
+            with metrics.stage('vector_rescore'):
+                return self._rescore(snapshot, ids, query, limit)
+
+        with metrics.stage('vector_scan'):
+            ids, scores = snapshot.index.search(query, limit, mask=mask)
+        return [(snapshot.skus[i], float(score)) for i, score in zip(ids, scores)]
+
+    def search_many(self, query_vecs, limit=20, filters=None):
+        """
+        search() for many query vectors at once: the index scores them
+        with matrix-matrix products. Returns one result list per query.
+        """
+        snapshot = self._snapshot
+        if limit <= 0 or len(snapshot.skus) == 0 or len(query_vecs) == 0:
+            return [[] for _ in query_vecs]
+        mask = None
+        if filters is not None:
+            mask = search_filters.row_mask(snapshot, filters)
+            if not mask.any():
+                return [[] for _ in query_vecs]
+
+        queries = np.asarray(query_vecs, dtype=np.float32).reshape(len(query_vecs), -1)
+        norms = np.linalg.norm(queries, axis=1)
+        valid = np.flatnonzero(norms > 0)
+        queries = queries[valid] / norms[valid, None]
+        quantized = isinstance(snapshot.matrix, QuantizedMatrix)
+        with metrics.stage('vector_scan'):
+            hits = snapshot.index.search_many(
+                queries, limit * VECTOR_RESCORE_FACTOR if quantized else limit, mask=mask
+            )
+
+        results = [[] for _ in query_vecs]
+        if quantized:
+            with metrics.stage('vector_rescore'):
+                for i, query, (ids, _) in zip(valid, queries, hits):
+                    results[i] = self._rescore(snapshot, ids, query, limit)
+        else:
+            for i, (ids, scores) in zip(valid, hits):
+                results[i] = [(snapshot.skus[j], float(score)) for j, score in zip(ids, scores)]
+        return results
+
+    def _rescore(self, snapshot, ids, query, limit):
+        """Exact cosine scores for coarse-scan candidates from the mapped full-precision rows"""
+        if len(ids) == 0 or snapshot.full is None:
+            return []
+        # Sorted ids read the mapped file in order
+        ids = np.sort(ids)
+        scores = np.asarray(snapshot.full[ids]) @ query
+        best = np.argsort(-scores)[:limit]
+        return [(snapshot.skus[ids[i]], float(scores[i])) for i in best]
+
+    def status(self):
+        snapshot = self._snapshot
+        return {
+            "loaded": self.loaded,
+            "version": snapshot.version,
+            "size": len(snapshot.skus),
+            "dims": snapshot.matrix.shape[1] if snapshot.matrix.ndim == 2 else 0,
+            "index": snapshot.index.kind,
+            "storage": getattr(snapshot.matrix, 'storage', 'float32'),
+            "source": snapshot.source,
+            "memory_bytes": snapshot.matrix.nbytes,
+            "updated_at": str(snapshot.marker[1]) if snapshot.marker else None,
+            "loaded_at": snapshot.loaded_at,
+        }
+
+    def start_refresher(self, connect, interval=VECTOR_REFRESH_INTERVAL):
+        """Run refresh() every `interval` seconds in a background thread"""
+        if interval <= 0:
+            return None
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh(connect)
+                except Exception as e:
+                    print(f"Vector store refresh failed: {e}")
+
+        thread = threading.Thread(target=run, name='vector-store-refresher', daemon=True)
+        thread.start()
+        return thread
+
+
+def read_marker(cursor):
+    cursor.execute("SELECT COUNT(*), MAX(updated_at) FROM embeddings WHERE vec IS NOT NULL")
+    return tuple(cursor.fetchone())
+
+
+def _apply_delta(snapshot, new_skus, new_rows):
+    """
+    Copy the snapshot's matrix, overwrite changed rows and append new ones.
+    Returns (skus, matrix, full-precision rows for quantized storage).
+    """
+    replace_ids = []
+    replace_rows = []
+    appended_skus = []
+    appended = []
+    for sku, row in zip(new_skus, new_rows):
+        i = snapshot.rows.get(sku)
+        if i is None:
+            appended_skus.append(sku)
+            appended.append(row)
+        else:
+            replace_ids.append(i)
+            replace_rows.append(row)
+
+    skus = snapshot.skus
+    if appended:
+        skus = np.concatenate([skus, np.array(appended_skus, dtype=object)])
+
+    if isinstance(snapshot.matrix, QuantizedMatrix):
+        full = snapshot.full.with_rows(replace_ids, replace_rows, appended, len(snapshot.skus))
+        return skus, snapshot.matrix.with_rows(replace_ids, replace_rows, appended), full
+
+    matrix = snapshot.matrix.copy()
+    if replace_ids:
+        matrix[replace_ids] = replace_rows
+    if appended:
+        matrix = np.concatenate([matrix, np.stack(appended)]) if len(matrix) else np.stack(appended)
+    return skus, np.ascontiguousarray(matrix), None
+
+
+def build_matrix(rows):
+    """
+    Build (skus, matrix) from (sku, vec_blob) rows. Rows whose dimension does
+    not match the first vector are skipped.
+    """
+    if not rows:
+        return np.empty(0, dtype=object), np.empty((0, 0), dtype=np.float32)
+
+    dims = len(rows[0][1]) // 4
+    skus = []
+    matrix = np.empty((len(rows), dims), dtype=np.float32)
+    n = 0
+    for sku, vec_blob in rows:
+        # 'vec' is a BLOB of float32 values (1536 bytes for 384 dims)
+        vec = np.frombuffer(vec_blob, dtype=np.float32)
+        if vec.shape[0] != dims:
+            print(f"Skipping embedding for {sku}: expected {dims} dims, got {vec.shape[0]}")
+            continue
+        matrix[n] = vec
+        skus.append(sku)
+        n += 1
+    matrix = matrix[:n]
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return np.array(skus, dtype=object), np.ascontiguousarray(matrix)
+
+
+_store = VectorStore()
+
+
+def get_vector_store():
+    """Return the process-wide vector store"""
+    return _store